@@ -4,9 +4,33 @@
 
 # Default client configuration
 SERVER_NOT_RESPONDING_TIMEOUT = 60  # After this time client will close connection
-CLIENT_ACK_TIMEOUT = 0.001          # How much time server has for process confirmation (ACK)
+CLIENT_WINDOW_SIZE = 32             # How many messages client can accept ahead of the last confirmed one
+CLIENT_ACK_EVERY = 4                # After how many received messages client sends ACK
+CLIENT_ACK_DELAY = 0.005            # How long received message can wait for confirmation (ACK)
+CLIENT_FILE_BUFFER_SIZE = 1 << 20   # Size of write buffer, when received data is saved to file
+CLIENT_JOURNAL_SUFFIX = ".part"     # Extension of files with progress of interrupted downloads
+CLIENT_JOURNAL_INTERVAL = 1 << 22   # After how many downloaded bytes progress is saved in journal
+CLIENT_STRIPES = 4                  # How many sessions download parts of one file at once
 
 # Default server configuration
 CLIENT_NOT_RESPONDING_TIMEOUT = 60  # After this time server will close connection
 NEXT_MESSAGE_TIMEOUT = 15           # How much time there is for new message to show up
-SERVER_ACK_TIMEOUT = 0.001          # How much time client has for confirmation (ACK)
+SERVER_ACK_TIMEOUT = 0.1            # How much time client has for confirmation (ACK) before round trip is measured
+SERVER_MIN_ACK_TIMEOUT = 0.001      # Lower limit of ACK timeout computed from round trip time
+SERVER_MAX_ACK_TIMEOUT = 10         # Upper limit of ACK timeout computed from round trip time
+SERVER_WINDOW_SIZE = 32             # How many messages can be sent without confirmation (ACK)
+SERVER_TIMER_TICK = 0.005           # Resolution of retransmission timers in event loop server
+SERVER_WORKER_TIMEOUT = 30          # How much time worker process has for start, stop and answers
+SERVER_PROBE_ATTEMPTS = 2           # How many times probe is sent before its size is considered too big
+SERVER_MAX_PROBES = 12              # How many sizes can be probed at the start of session
+SERVER_MIN_PROBE_TIMEOUT = 0.05     # Lower limit of time for confirmation of probe
+SERVER_PROBE_PRECISION = 16         # Probing ends when the biggest safe size of data is known with this precision
+SERVER_INITIAL_WINDOW = 10          # How many messages can be sent before congestion window is adjusted by ACKs
+SERVER_MIN_WINDOW = 4               # Congestion window never drops below it, client confirms every few messages
+SERVER_PACING_BURST = 0.005         # How long (in seconds) data can be sent at full speed over the rate limit
+SERVER_REORDER_THRESHOLD = 3        # Missing message is lost, when this many messages sent after it are confirmed
+
+# Default stream configuration
+STREAM_QUEUE_SIZE = 1024            # How many messages of live stream can wait for one session
+MANIFEST_SUFFIX = ".manifest"       # Extension of files with saved digests of file chunks
+MANIFEST_PARALLEL_SIZE = 1 << 24    # Manifest of smaller files isn't computed by many processes
@@ -0,0 +1,189 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import argparse
+import json
+import logging
+import socket
+from threading import Thread
+from time import perf_counter, time
+from message import Message, DataMessage, MessageType, HashType
+from common import setup_loggers, send_message, receive_message, MessageBuffer
+from client import ClientV4, ClientV6
+from server import MultiProcessServer
+from streams import Stream, File, Ping
+from proxy import LossyProxy, NetworkConditions
+
+
+def measure(task, count: int) -> float:
+    # Returns number of messages handled per second
+    start = perf_counter()
+    for _ in range(count):
+        task()
+    return count / (perf_counter() - start)
+
+
+def codec_benchmark(count: int = 100000) -> dict:
+    """
+    Microbenchmark of message codec: building messages with every hash, packing, unpacking and sending
+    messages through loopback, with new buffers for every message and with buffers reused for the whole socket.
+    """
+    logger = setup_loggers(logging.CRITICAL)
+    data = bytes(Message.MAX_DATA_SIZE)
+    results = {f"pack_{hash_type.name.lower()}": measure(lambda: DataMessage(1, data, hash_type).pack(), count)
+               for hash_type in HashType}
+
+    message = DataMessage(1, data)
+    packed_message = message.pack()
+    send_buffer, receive_buffer = MessageBuffer(), MessageBuffer()
+
+    receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receive_socket.bind(("127.0.0.1", 0))
+    send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receive_socket.getsockname()
+
+    def transfer(buffer_in, buffer_out):
+        send_message(send_socket, message, address, logger, buffer_in)
+        receive_message(receive_socket, logger, buffer_out)
+
+    try:
+        return results | {
+            "pack": measure(message.pack, count),
+            "pack_into": measure(lambda: message.pack_into(send_buffer.view), count),
+            "unpack": measure(lambda: Message.unpack(packed_message), count),
+            "unpack_view": measure(lambda: Message.unpack(send_buffer.view[:len(packed_message)]), count),
+            "transfer": measure(lambda: transfer(None, None), count),
+            "transfer_buffered": measure(lambda: transfer(send_buffer, receive_buffer), count),
+        }
+    finally:
+        receive_socket.close()
+        send_socket.close()
+
+
+class LatencyRecorder:
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = []
+
+    def receive_message(self) -> Message:
+        # Server and client run on the same host, so timestamp of message tells how long it was on the way
+        message = super().receive_message()
+        if message.message_type == MessageType.MSG:
+            self.latencies.append(time() - message.timestamp)
+        return message
+
+
+class MeasuredClientV4(LatencyRecorder, ClientV4):
+    pass
+
+
+class MeasuredClientV6(LatencyRecorder, ClientV6):
+    pass
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def load_benchmark(stream: Stream, clients: int = 8, max_messages: int = None, version: int = 4, workers: int = 1,
+                   hash_type: HashType = HashType.SHA3, conditions: NetworkConditions = None,
+                   fec_group: int = 0) -> dict:
+    """
+    Load test of the whole protocol: many clients request the same stream at once from a server running
+    in separate processes, so CPU time of the server isn't mixed with clients.
+
+    :param stream: stream requested by every client
+    :param clients: number of concurrent sessions
+    :param max_messages: how many messages every client receives, required for infinite streams
+    :param version: IP version of clients
+    :param workers: number of server processes
+    :param conditions: impairments of emulated network between clients and server, direct connection if None
+    :param fec_group: number of data messages protected by one parity message, 0 without parity
+    """
+    server = MultiProcessServer(ipv4_receive_address=("127.0.0.1", 0), ipv6_receive_address=("::1", 0, 0, 0),
+                                workers=workers, logging_level=logging.CRITICAL)
+    server.start()
+    server.register_stream(1, stream)
+    target_address = server.ipv4_receive_address[:2] if version == 4 else server.ipv6_receive_address[:2]
+    proxy = None
+    if conditions is not None:
+        proxy = LossyProxy(target_address, conditions, logging_level=logging.CRITICAL)
+        proxy.start()
+        target_address = proxy.receive_address[:2]
+    client_class = MeasuredClientV4 if version == 4 else MeasuredClientV6
+    sessions = [client_class(logging_level=logging.CRITICAL, turn_on_signals=False, hash_type=hash_type,
+                             fec_group=fec_group) for _ in range(clients)]
+    received = [0] * clients
+
+    def receive(idx: int):
+        for data in sessions[idx].iter_request(1, target_address, max_messages):
+            received[idx] += len(data)
+
+    try:
+        start_stats = server.get_stats()
+        start = perf_counter()
+        threads = [Thread(target=receive, args=(idx,)) for idx in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = perf_counter() - start
+        stats = server.get_stats()
+    finally:
+        if proxy is not None:
+            proxy.stop()
+        server.stop()
+
+    latencies = [latency for session in sessions for latency in session.latencies]
+    return {"clients": clients,
+            "version": version,
+            "workers": workers,
+            "duration": duration,
+            "received_bytes": sum(received),
+            "goodput": sum(received) / duration,
+            "packets_per_second": len(latencies) / duration,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p99": percentile(latencies, 0.99),
+            "sent_messages": stats["sent_messages"] - start_stats["sent_messages"],
+            "retransmissions": stats["retransmissions"] - start_stats["retransmissions"],
+            "parity_messages": stats["parity_messages"] - start_stats["parity_messages"],
+            "recovered_messages": sum(session.recovered_messages for session in sessions),
+            "server_cpu_time": stats["cpu_time"] - start_stats["cpu_time"],
+            "network": proxy.get_stats() if proxy is not None else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures messages per second of message codec, "
+                                                 "or throughput and latency of concurrent sessions")
+    parser.add_argument("--count", type=int, default=100000, help="number of messages in every codec test")
+    parser.add_argument("--clients", type=int, default=0, help="number of concurrent clients, load test if given")
+    parser.add_argument("--file", help="file requested by clients, ping stream if not given")
+    parser.add_argument("--delay", type=float, default=0.001, help="delay between messages of ping stream")
+    parser.add_argument("--messages", type=int, help="messages received by every client, required for ping stream")
+    parser.add_argument("--ipv6", action="store_true", help="clients connect with IPv6")
+    parser.add_argument("--workers", type=int, default=1, help="number of server processes")
+    parser.add_argument("--hash", choices=[hash_type.name for hash_type in HashType], default=HashType.SHA3.name)
+    parser.add_argument("--loss", type=float, default=0, help="probability that datagram is lost")
+    parser.add_argument("--duplication", type=float, default=0, help="probability that datagram is duplicated")
+    parser.add_argument("--reordering", type=float, default=0, help="probability that datagram is reordered")
+    parser.add_argument("--latency", type=float, default=0, help="one-way delay of emulated network in seconds")
+    parser.add_argument("--jitter", type=float, default=0, help="max random delay added to every datagram")
+    parser.add_argument("--bandwidth", type=float, help="capacity of emulated network in bytes per second")
+    parser.add_argument("--seed", type=int, help="seed of emulated network, runs with the same seed are comparable")
+    parser.add_argument("--fec", type=int, default=0, help="data messages protected by one parity message")
+    args = parser.parse_args()
+    if args.clients > 0:
+        benchmark_stream = File(args.file, use_mmap=True) if args.file else Ping(args.delay)
+        network = None
+        if args.loss or args.duplication or args.reordering or args.latency or args.jitter or args.bandwidth:
+            network = NetworkConditions(args.loss, args.duplication, args.reordering, args.latency, args.jitter,
+                                        bandwidth=args.bandwidth, seed=args.seed)
+        results = load_benchmark(benchmark_stream, args.clients, args.messages or (None if args.file else 1000),
+                                 6 if args.ipv6 else 4, args.workers, HashType[args.hash], network, args.fec)
+    else:
+        results = codec_benchmark(args.count)
+    print(json.dumps(results, indent=2))
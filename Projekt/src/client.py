@@ -2,95 +2,448 @@
 # Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
 # Data:           14.01.2022
 
+import asyncio
 import logging
+import os
+import selectors
 import signal
 import socket
-from time import sleep
-from message import Message, RequestMessage, ACKMessage, QuitMessage, MessageType, ErrorType
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, monotonic
+from message import Message, RequestMessage, DataMessage, ACKMessage, ProbeMessage, ParityMessage, MessageType, \
+    ErrorType, HashType, QUIT_MESSAGE
 from common import setup_loggers, receive_message, send_message, setup_sockets_ipv4, setup_sockets_ipv6
 import CONFIG as CFG
 
 
+class ReorderBuffer:
+    def __init__(self, capacity: int):
+        """
+        Holds messages received ahead of the expected one and releases them in order once the gap is filled.
+
+        :param capacity: how many messages after the expected one can be held (receive window)
+        """
+        self.capacity = capacity
+        self.messages = {}
+        self.next_identifier = 1
+        self.skip_to = 1
+        self.buffered = 0
+        self.skipped = 0
+        self.discarded = 0
+        self.duplicates = 0
+
+    def add(self, message: Message) -> bool:
+        if self.is_received(message.identifier):
+            self.duplicates += 1
+            return False
+        if message.identifier >= self.next_identifier + self.capacity:
+            self.discarded += 1
+            return False
+        if message.identifier != self.next_identifier:
+            self.buffered += 1
+        self.messages[message.identifier] = message
+        return True
+
+    def pop(self):
+        while True:
+            message = self.messages.pop(self.next_identifier, None)
+            if message is not None:
+                self.next_identifier += 1
+                return message
+            if self.next_identifier >= self.skip_to:
+                return None
+            # Server won't send this message anymore
+            self.next_identifier += 1
+            self.skipped += 1
+
+    def skip(self, identifier: int):
+        # Messages before identifier, which were already received, are still released
+        self.skip_to = max(self.skip_to, identifier)
+
+    def is_received(self, identifier: int) -> bool:
+        return identifier < self.next_identifier or identifier in self.messages
+
+    def received(self) -> list[int]:
+        return list(self.messages)
+
+    def stats(self) -> dict:
+        return {"held": len(self.messages), "buffered": self.buffered, "discarded": self.discarded,
+                "duplicates": self.duplicates, "skipped": self.skipped}
+
+
+class ParityDecoder:
+    def __init__(self, group_size: int):
+        """
+        Rebuilds lost message from parity message and the other messages of its group. Data of received
+        messages is kept as long as any group with missing message can need it.
+
+        :param group_size: max number of data messages protected by one parity message
+        """
+        self.GROUP_SIZE = group_size
+        self.data = {}
+        self.parities = {}
+        self.oldest = 1
+        self.recovered = 0
+
+    def add_data(self, message: Message, buffer: ReorderBuffer) -> list[Message]:
+        self.data[message.identifier] = message.data
+        # Message could be the last missing one before lost message in group with known parity
+        return [recovered for first in range(message.identifier - self.GROUP_SIZE + 1, message.identifier + 1)
+                if first in self.parities and (recovered := self.recover(first, buffer)) is not None]
+
+    def add_parity(self, message: Message, buffer: ReorderBuffer) -> list[Message]:
+        self.parities[message.identifier] = message
+        recovered = self.recover(message.identifier, buffer)
+        return [] if recovered is None else [recovered]
+
+    def recover(self, first: int, buffer: ReorderBuffer):
+        parity = self.parities[first]
+        count, size_parity = ParityMessage.DATA.unpack_from(parity.data)
+        identifiers = range(first, first + count)
+        missing = [idx for idx in identifiers if not buffer.is_received(idx)]
+        if not missing:
+            del self.parities[first]
+            return None
+        if len(missing) > 1 or any(idx not in self.data for idx in identifiers if idx != missing[0]):
+            # Parity rebuilds only one message of the group. Data of skipped messages is unknown
+            return None
+        del self.parities[first]
+        data = int.from_bytes(parity.data[ParityMessage.DATA.size:], "little")
+        for idx in identifiers:
+            if idx != missing[0]:
+                data ^= int.from_bytes(self.data[idx], "little")
+                size_parity ^= len(self.data[idx])
+        self.recovered += 1
+        return DataMessage(missing[0], data.to_bytes(size_parity, "little"), parity.hash_type)
+
+    def forget(self, delivered: int):
+        # Groups with messages after the delivered one start after delivered - GROUP_SIZE
+        while self.oldest <= delivered - self.GROUP_SIZE:
+            self.data.pop(self.oldest, None)
+            self.parities.pop(self.oldest, None)
+            self.oldest += 1
+
+
+class ReceiveChannel:
+    def __init__(self, index: int, stream: int, capacity: int, fec_group: int = 0):
+        """
+        Receiving state of one stream sent in the session, every stream has its own identifiers and ACKs.
+
+        :param index: channel of the stream in the session, order of streams in the request
+        :param stream: requested stream
+        :param capacity: size of receive window
+        :param fec_group: max number of data messages protected by one parity message, 0 without parity
+        """
+        self.index = index
+        self.stream = stream
+        self.buffer = ReorderBuffer(capacity)
+        self.decoder = ParityDecoder(fec_group) if fec_group > 0 else None
+        self.delivered = deque()
+        self.stream_size = -1
+        self.total_size = -1
+        self.version = 0
+        self.received_size = 0
+        self.pkg_number = 0
+        self.not_confirmed = 0
+        self.ack_deadline = 0
+        self.ack_requested = False
+        self.last_timestamp = None
+
+    def is_complete(self) -> bool:
+        return 0 <= self.stream_size <= self.received_size
+
+    def postpone_ack(self, delay: float):
+        if self.not_confirmed == 0:
+            self.ack_deadline = monotonic() + delay
+        self.not_confirmed += 1
+
+    def ack_due(self, ack_every: int, now: float) -> bool:
+        # One ACK confirms many messages, it's sent after few of them or when the oldest one waits too long
+        return self.ack_requested or self.not_confirmed >= ack_every \
+            or (self.not_confirmed > 0 and now >= self.ack_deadline)
+
+
 class ClientV4:
+    # Journal of download has requested stream, number of bytes saved in file and size and version of the stream
+    JOURNAL = struct.Struct("=iqqq")
+
     def __init__(self,
                  receive_address: tuple[str, int] = ("", 0),
                  send_address: tuple[str, int] = ("", 0),
                  logging_level: int = logging.INFO,
-                 turn_on_signals: bool = True):
+                 turn_on_signals: bool = True,
+                 hash_type: HashType = HashType.SHA3,
+                 fec_group: int = 0):
+        """
+        :param hash_type: hash protecting data, weaker hash (or none) is cheaper, e.g. in trusted local network
+        :param fec_group: server sends parity message after this many data messages, so one lost message
+                          of every group is rebuilt without retransmission, 0 without parity
+        """
         self.logger = setup_loggers(logging_level)
         if turn_on_signals:
             self.setup_exit_handler()
 
         self.SERVER_NOT_RESPONDING_TIMEOUT = CFG.SERVER_NOT_RESPONDING_TIMEOUT
-        self.CLIENT_ACK_TIMEOUT = CFG.CLIENT_ACK_TIMEOUT
-        self.server_lag = 0
+        self.ACK_EVERY = CFG.CLIENT_ACK_EVERY
+        self.ACK_DELAY = CFG.CLIENT_ACK_DELAY
+        self.HASH_TYPE = hash_type
+        self.FEC_GROUP = fec_group
+        # Time of the last progress of transmission, server is not responding when it's too old
+        self.last_progress = monotonic()
 
+        # Receive socket is non-blocking, client waits for it in selector until the nearest deadline
         self.receive_socket, self.send_socket = self.setup_sockets(receive_address, send_address)
+        # Whole window of the biggest messages has to fit in socket buffer, otherwise it's dropped by the system
+        self.receive_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                       2 * CFG.CLIENT_WINDOW_SIZE * Message.MAX_MESSAGE_SIZE)
         self.receive_port = self.receive_socket.getsockname()[1]
+        # stop() can be called from other thread, it wakes up the waiting client
+        self.wakeup_socket, self.wakeup_sender = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.receive_socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_socket, selectors.EVENT_READ)
 
         self.is_running = True
 
-        self.result = b""
-        self.pkg_number = 0
+        self.result = bytearray()
+        self.result_size = 0
         self.data_pkg_number = 0
+        self.channels = [ReceiveChannel(0, 0, CFG.CLIENT_WINDOW_SIZE, fec_group)]
 
         self.target_ip = None
         self.ack_port = None
+        # Reason of rejected request, None if server didn't send error
+        self.error = None
+        # Sessions downloading parts of the file in download_striped()
+        self.stripe_clients = []
+
+    @property
+    def buffer(self) -> ReorderBuffer:
+        # Receive window of the first requested stream, the others are created with the same capacity
+        return self.channels[0].buffer
+
+    @property
+    def stream_size(self) -> int:
+        return self.channels[0].stream_size
+
+    @property
+    def recovered_messages(self) -> int:
+        # Messages rebuilt from parity, server didn't have to send them again
+        return sum(channel.decoder.recovered for channel in self.channels if channel.decoder is not None)
 
     def setup_sockets(self, receive_address, send_address):
-        return setup_sockets_ipv4(receive_address, self.CLIENT_ACK_TIMEOUT, send_address)
+        return setup_sockets_ipv4(receive_address, 0, send_address)
 
     def setup_exit_handler(self):
         signal.signal(signal.SIGINT, lambda sig, frame: self.stop())
 
     def stop(self):
         self.is_running = False
+        for client in self.stripe_clients:
+            client.stop()
+        try:
+            self.wakeup_sender.send(b"\0")
+        except OSError:
+            # Client is already woken up, buffer of wakeup socket is full
+            pass
 
-    def receive_transmission(self, max_messages: int = None):
-        while self.is_running:
-            if self.listen_for_data(max_messages):
-                if self.ack_port is not None:
-                    self.send_message(ACKMessage(self.pkg_number), (self.target_ip, self.ack_port))
+    def close(self):
+        # Sockets are released, client can't be used anymore
+        self.selector.close()
+        self.receive_socket.close()
+        self.send_socket.close()
+        self.wakeup_socket.close()
+        self.wakeup_sender.close()
 
-        if not self.is_running and self.target_ip and self.ack_port:
-            # Client is closing connection
-            self.send_message(QuitMessage(1), (self.target_ip, self.ack_port))
+    def receive_transmission(self, max_messages: int = None):
+        for data in self.receive_chunks(max_messages):
+            self.store(data)
+        del self.result[self.result_size:]
         return self.result
 
-    def listen_for_data(self, max_messages) -> bool:
+    def receive_chunks(self, max_messages: int = None):
+        for _, data in self.receive_streams(max_messages):
+            yield data
+
+    def receive_streams(self, max_messages: int = None):
         try:
             while self.is_running:
-                message = self.receive_message()
-                if message.message_type == MessageType.FIN:
-                    self.logger.info("Transmission ended")
-                    self.is_running = False
-                elif message.message_type == MessageType.ERR:
-                    self.logger.error(f"{ErrorType(message.identifier).name}")
-                    self.is_running = False
-                elif message.message_type == MessageType.INF:
-                    ack_port = message.data_to_int()
-                    if self.ack_port != ack_port:
-                        self.ack_port = ack_port
-                        self.logger.info(f'Sending ACKs to: {ack_port}')
-                        return True
-                elif message.identifier == self.pkg_number + 1 and message.message_type == MessageType.MSG and message.check_hash():
-                    self.pkg_number += 1
-                    self.server_lag = 0
-                    if message.size != 0:
-                        self.data_pkg_number += 1
-                        self.result += message.data
-                        if self.data_pkg_number != max_messages:
-                            return True
-                        else:
-                            self.logger.info(f'Limit of received packages reached. Ending transmission.')
-                            self.is_running = False
-        except socket.timeout:
-            self.server_lag = self.server_lag + self.CLIENT_ACK_TIMEOUT
-            if self.server_lag >= self.SERVER_NOT_RESPONDING_TIMEOUT:
+                if self.listen_for_data(max_messages):
+                    if self.ack_port is not None:
+                        self.send_acks()
+                yield from self.take_delivered()
+            yield from self.take_delivered()
+        finally:
+            # Client is closing connection, also when the caller stopped reading
+            self.is_running = False
+            if self.target_ip and self.ack_port:
+                self.send_acks()
+                self.send_message(QUIT_MESSAGE, (self.target_ip, self.ack_port))
+
+    def take_delivered(self):
+        for channel in self.channels:
+            while channel.delivered:
+                yield channel.index, channel.delivered.popleft()
+
+    def get_channel(self, message: Message):
+        if message.channel < len(self.channels):
+            return self.channels[message.channel]
+        self.logger.warning(f"Message of unknown channel {message.channel}")
+        return None
+
+    def listen_for_data(self, max_messages) -> bool:
+        while self.is_running:
+            for key, _ in self.selector.select(self.next_timeout()):
+                if key.fileobj is self.wakeup_socket:
+                    self.clear_wakeup()
+            try:
+                if self.receive_messages(max_messages):
+                    return True
+            except BlockingIOError:
+                # Every waiting message is handled, received data can be delivered
+                if any(channel.delivered for channel in self.channels):
+                    return self.ack_due()
+            if monotonic() - self.last_progress >= self.SERVER_NOT_RESPONDING_TIMEOUT:
                 self.logger.info("Server not responding: timeout")
                 self.is_running = False
+            elif self.ack_due():
+                return True
         return False
 
+    def next_timeout(self) -> float:
+        # Client sleeps until ACK has to be sent or server is considered not responding
+        deadline = self.last_progress + self.SERVER_NOT_RESPONDING_TIMEOUT
+        for channel in self.channels:
+            if channel.ack_requested:
+                return 0
+            if channel.not_confirmed > 0:
+                deadline = min(deadline, channel.ack_deadline)
+        return max(0.0, deadline - monotonic())
+
+    def clear_wakeup(self):
+        try:
+            while self.wakeup_socket.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def receive_messages(self, max_messages) -> bool:
+        # Reads messages until socket is empty (BlockingIOError), returns True when ACK should be sent at once
+        while self.is_running:
+            message = self.receive_message()
+            if message.message_type == MessageType.FIN:
+                self.logger.info("Transmission ended")
+                self.is_running = False
+            elif message.message_type == MessageType.ERR:
+                self.error = ErrorType(message.identifier)
+                self.logger.error(f"{self.error.name}")
+                self.is_running = False
+            elif message.message_type == MessageType.INF and (channel := self.get_channel(message)):
+                channel.last_timestamp = message.timestamp
+                ack_port = message.data_to_int()
+                if self.ack_port != ack_port:
+                    self.ack_port = ack_port
+                    self.logger.info(f'Sending ACKs to: {ack_port}')
+                if message.size >= 12:
+                    channel.stream_size = message.data_to_long(1)
+                    channel.total_size = message.data_to_long(3) if message.size >= 20 else channel.stream_size
+                    channel.version = message.data_to_long(5) if message.size >= 28 else 0
+                channel.ack_requested = True
+                return True
+            elif message.message_type in (MessageType.MSG, MessageType.SKP) \
+                    and message.hash_type == self.HASH_TYPE and message.check_hash() \
+                    and (channel := self.get_channel(message)):
+                channel.last_timestamp = message.timestamp
+                if message.message_type == MessageType.SKP:
+                    # Announcement is applied at once, it can't wait for messages which won't come
+                    channel.buffer.skip(message.data_to_int())
+                    self.accept_messages(channel, max_messages)
+                if self.add_message(channel, message, max_messages):
+                    if channel.decoder is not None and message.message_type == MessageType.MSG:
+                        for recovered in channel.decoder.add_data(message, channel.buffer):
+                            self.add_message(channel, recovered, max_messages)
+                elif channel.buffer.is_received(message.identifier):
+                    # Message was already received, server didn't get my ACK
+                    channel.ack_requested = True
+                    return True
+            elif message.message_type == MessageType.PAR and message.hash_type == self.HASH_TYPE \
+                    and message.check_hash() and (channel := self.get_channel(message)) and channel.decoder is not None:
+                for recovered in channel.decoder.add_parity(message, channel.buffer):
+                    self.add_message(channel, recovered, max_messages)
+            elif message.message_type == MessageType.PRB and message.hash_type == self.HASH_TYPE \
+                    and message.check_hash():
+                # Probe got through whole, server can send messages of its size
+                self.send_message(ProbeMessage(message.identifier, False, self.HASH_TYPE),
+                                  (self.target_ip, self.ack_port))
+            if self.is_running and self.ack_due():
+                return True
+        return False
+
+    def ack_due(self) -> bool:
+        now = monotonic()
+        return any(channel.ack_due(self.ACK_EVERY, now) for channel in self.channels)
+
+    def send_acks(self):
+        now = monotonic()
+        for channel in self.channels:
+            if channel.ack_due(self.ACK_EVERY, now):
+                self.send_ack(channel)
+
+    def send_ack(self, channel: ReceiveChannel):
+        channel.not_confirmed = 0
+        channel.ack_requested = False
+        self.send_message(ACKMessage(channel.pkg_number, channel.buffer.received(), channel.last_timestamp,
+                                     self.HASH_TYPE, channel.index), (self.target_ip, self.ack_port))
+
+    def add_message(self, channel: ReceiveChannel, message: Message, max_messages) -> bool:
+        if not channel.buffer.add(message):
+            return False
+        self.accept_messages(channel, max_messages)
+        channel.postpone_ack(self.ACK_DELAY)
+        return True
+
+    def accept_messages(self, channel: ReceiveChannel, max_messages) -> bool:
+        accepted = False
+        while self.is_running:
+            message = channel.buffer.pop()
+            if message is None:
+                break
+            self.last_progress = monotonic()
+            accepted = True
+            if message.message_type == MessageType.MSG and message.size != 0:
+                self.data_pkg_number += 1
+                channel.received_size += message.size
+                channel.delivered.append(message.data)
+                if self.data_pkg_number == max_messages:
+                    self.logger.info(f'Limit of received packages reached. Ending transmission.')
+                    self.is_running = False
+                elif channel.is_complete() and all(other.is_complete() for other in self.channels):
+                    # Whole streams are received, client doesn't wait for end of session, which can be lost
+                    self.logger.info("All streams received")
+                    for other in self.channels:
+                        other.ack_requested = True
+                    self.is_running = False
+        # Skipped messages are confirmed too, server doesn't wait for them
+        channel.pkg_number = channel.buffer.next_identifier - 1
+        if channel.decoder is not None:
+            channel.decoder.forget(channel.pkg_number)
+        return accepted
+
+    def reserve(self, stream_size: int):
+        # Whole stream fits in the buffer, received data doesn't have to be copied when it grows
+        if self.result_size == 0 and stream_size > len(self.result):
+            self.result = bytearray(stream_size)
+
+    def store(self, data: bytes):
+        if self.result_size == 0:
+            self.reserve(self.stream_size)
+        end = self.result_size + len(data)
+        self.result[self.result_size:end] = data
+        self.result_size = end
+
     def receive_message(self) -> Message:
         message, _ = receive_message(self.receive_socket, self.logger)
         return message
@@ -98,22 +451,239 @@ class ClientV4:
     def send_message(self, message: Message, target: tuple[str, int]):
         send_message(self.send_socket, message, target, self.logger)
 
-    def request(self, stream: int, target: tuple[str, int], filename: str = None, max_messages: int = None):
+    def send_request(self, stream: int, target: tuple[str, int], streams: tuple[int, ...] = (), start: int = 0,
+                     length: int = -1):
         self.target_ip, _ = target
-        self.send_message(RequestMessage(stream, self.receive_port), target)
+        self.last_progress = monotonic()
+        capacity = self.buffer.capacity
+        self.channels[0].stream = stream
+        self.channels[1:] = [ReceiveChannel(idx, extra_stream, capacity, self.FEC_GROUP)
+                             for idx, extra_stream in enumerate(streams, start=1)]
+        self.send_message(RequestMessage(stream, self.receive_port, capacity, self.HASH_TYPE,
+                                         Message.MAX_PAYLOAD_SIZE, streams, self.FEC_GROUP, start, length), target)
+
+    def request(self, stream: int, target: tuple[str, int], filename: str = None, max_messages: int = None,
+                start: int = 0, length: int = -1):
+        """
+        :param start: offset of the first requested byte, only file streams can be requested from the middle
+        :param length: number of requested bytes, -1 for the rest of the stream
+        """
+        self.send_request(stream, target, start=start, length=length)
         received_data = self.receive_transmission(max_messages)
         if filename is not None:
             with open(filename, 'wb+') as file:
                 file.write(received_data)
         return received_data
 
+    def iter_request(self, stream: int, target: tuple[str, int], max_messages: int = None, start: int = 0,
+                     length: int = -1):
+        """
+        Requests stream and yields received data in order, as soon as it arrives. Only messages
+        from receive window are kept in memory, no matter how long the stream is.
+        """
+        self.send_request(stream, target, start=start, length=length)
+        yield from self.receive_chunks(max_messages)
+
+    async def aiter_request(self, stream: int, target: tuple[str, int], max_messages: int = None):
+        """
+        Asynchronous version of iter_request(), sockets are handled in a separate thread.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = self.iter_request(stream, target, max_messages)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                while (data := await loop.run_in_executor(executor, next, chunks, None)) is not None:
+                    yield data
+            finally:
+                self.stop()
+                await loop.run_in_executor(executor, chunks.close)
+
+    def iter_request_many(self, streams: list[int], target: tuple[str, int], max_messages: int = None):
+        """
+        Requests few streams in one session and yields received data of all of them as soon as it arrives.
+        Data of every stream is in order, streams are interleaved as server shares the session between them.
+
+        :param streams: requested streams, at most Message.MAX_CHANNELS
+        :return: pairs of position of the stream in streams and its data
+        """
+        self.send_request(streams[0], target, tuple(streams[1:]))
+        yield from self.receive_streams(max_messages)
+
+    def request_many(self, streams: list[int], target: tuple[str, int], max_messages: int = None) -> list[bytearray]:
+        results = [bytearray() for _ in streams]
+        for idx, data in self.iter_request_many(streams, target, max_messages):
+            results[idx] += data
+        return results
+
+    def download(self, stream: int, target: tuple[str, int], filename: str, max_messages: int = None,
+                 resume: bool = True) -> int:
+        """
+        Requests stream and writes received data straight to file. Until the whole stream is received,
+        progress is saved in journal next to the file, so interrupted download of file stream continues
+        from the last saved position.
+
+        :param resume: continue download saved in journal, otherwise the whole stream is requested again
+        :return: number of bytes written by this call
+        """
+        journal = f"{filename}{CFG.CLIENT_JOURNAL_SUFFIX}"
+        start, identity = self.load_journal(journal, filename, stream) if resume else (0, None)
+        written = 0
+        changed = False
+        with open(filename, 'r+b' if start > 0 else 'wb', buffering=CFG.CLIENT_FILE_BUFFER_SIZE) as file:
+            # Data after saved position could be written only partially
+            file.truncate(start)
+            file.seek(start)
+            saved = start
+            try:
+                for data in self.iter_request(stream, target, max_messages, start=start):
+                    if start > 0 and self.get_identity() != identity:
+                        break
+                    written += file.write(data)
+                    if start + written - saved >= CFG.CLIENT_JOURNAL_INTERVAL:
+                        saved = start + written
+                        self.save_journal(journal, file, stream, saved, self.get_identity())
+            finally:
+                # Stream changed, when the rest doesn't belong to the same version or it's shorter than saved part
+                changed = start > 0 and (self.error == ErrorType.RANGE_NOT_SATISFIABLE or
+                                         self.ack_port is not None and self.get_identity() != identity)
+                # Progress is saved also when download is interrupted by exception
+                if not changed and not self.channels[0].is_complete():
+                    self.save_journal(journal, file, stream, start + written, identity or self.get_identity())
+        if changed:
+            self.logger.warning(f"Stream {stream} changed since the last download, it's downloaded again")
+            return self.download_by_new_client(stream, target, filename, max_messages)
+        if self.channels[0].is_complete() and os.path.exists(journal):
+            os.remove(journal)
+        return written
+
+    def get_identity(self) -> tuple[int, int]:
+        # Size and version of the whole first stream, saved part of download belongs only to them
+        return self.channels[0].total_size, self.channels[0].version
+
+    def request_size(self, stream: int, target: tuple[str, int]) -> int:
+        """
+        Requests empty range of the stream, info message of the session tells size of the whole stream.
+
+        :return: size of the stream, -1 if it's unknown or stream can't be requested in ranges
+        """
+        self.send_request(stream, target, length=0)
+        self.receive_transmission()
+        return self.channels[0].total_size
+
+    def create_client(self):
+        return type(self)(logging_level=self.logger.level, turn_on_signals=False, hash_type=self.HASH_TYPE,
+                          fec_group=self.FEC_GROUP)
+
+    def download_by_new_client(self, stream: int, target: tuple[str, int], filename: str,
+                               max_messages: int = None) -> int:
+        # Whole stream is downloaded again in new session, its sockets are released when it ends
+        client = self.create_client()
+        try:
+            return client.download(stream, target, filename, max_messages, resume=False)
+        finally:
+            client.close()
+
+    def download_striped(self, stream: int, target: tuple[str, int], filename: str,
+                         stripes: int = CFG.CLIENT_STRIPES) -> int:
+        """
+        Downloads file stream in few sessions at once, every session gets its own range of the file
+        and writes it straight to its place in the file. Server sends every session from other thread
+        (or process), so big files aren't limited by one sender and round trips of sessions overlap.
+
+        :param stripes: number of sessions
+        :return: number of written bytes
+        :raises ConnectionError: when any range isn't received, incomplete file is removed
+        """
+        size = self.request_size(stream, target)
+        if size < 0:
+            # Only file streams can be split, other streams are downloaded by one session
+            self.logger.info(f"Size of stream {stream} is unknown, it isn't striped")
+            return self.download_by_new_client(stream, target, filename)
+
+        if size == 0:
+            # Empty file has no range to split, only the file is created
+            os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+            self.stripe_clients = []
+            return 0
+
+        # Ranges are multiples of the biggest message, so sessions which probed it send only full messages.
+        # Server uses saved digests only when range starts at a multiple of message size of its session.
+        stripe_size = -(-size // max(stripes, 1))
+        stripe_size = -(-stripe_size // Message.MAX_PAYLOAD_SIZE) * Message.MAX_PAYLOAD_SIZE
+        ranges = [(start, min(stripe_size, size - start)) for start in range(0, size, stripe_size)]
+        self.stripe_clients = [self.create_client() for _ in ranges]
+
+        def download_stripe(client: ClientV4, start: int, length: int) -> int:
+            written = 0
+            for data in client.iter_request(stream, target, start=start, length=length):
+                if client.get_identity() != self.get_identity():
+                    raise ConnectionError(f"Stream {stream} changed during download")
+                # Write can be shorter than data, e.g. when it's interrupted by signal
+                view = memoryview(data)
+                while view:
+                    count = os.pwrite(fd, view, start + written)
+                    written += count
+                    view = view[count:]
+            if not client.channels[0].is_complete():
+                raise ConnectionError(f"Range {start}-{start + length} of stream {stream} isn't complete")
+            return written
+
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        complete = False
+        try:
+            # File has its final size at once, stripes are written in any order
+            os.ftruncate(fd, size)
+            with ThreadPoolExecutor(max_workers=len(ranges) or 1) as executor:
+                futures = [executor.submit(download_stripe, client, start, length)
+                           for client, (start, length) in zip(self.stripe_clients, ranges)]
+                try:
+                    written = sum(future.result() for future in futures)
+                except BaseException:
+                    # File is useless without any of its ranges, the other sessions don't have to finish
+                    for client in self.stripe_clients:
+                        client.stop()
+                    raise
+            complete = True
+        finally:
+            os.close(fd)
+            for client in self.stripe_clients:
+                client.close()
+            if not complete:
+                # Missing ranges are filled with zeros, such file can't be mistaken for downloaded one
+                os.remove(filename)
+        return written
+
+    @staticmethod
+    def load_journal(journal: str, filename: str, stream: int) -> tuple[int, tuple[int, int]]:
+        # Returns position, from which download continues, and size and version of the stream,
+        # journal of other stream isn't used
+        try:
+            with open(journal, 'rb') as file:
+                saved_stream, position, *identity = ClientV4.JOURNAL.unpack(file.read(ClientV4.JOURNAL.size))
+            size = os.path.getsize(filename)
+        except (OSError, struct.error):
+            return 0, None
+        if saved_stream != stream:
+            return 0, None
+        return min(position, size), tuple(identity)
+
+    @staticmethod
+    def save_journal(journal: str, file, stream: int, position: int, identity: tuple[int, int]):
+        # Data has to be on disk before journal says it is, journal is replaced at once
+        file.flush()
+        os.fsync(file.fileno())
+        temporary_path = f"{journal}.{os.getpid()}"
+        with open(temporary_path, 'wb') as journal_file:
+            journal_file.write(ClientV4.JOURNAL.pack(stream, position, *identity))
+        os.replace(temporary_path, journal)
+
 
 class ClientV6(ClientV4):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     def setup_sockets(self, receive_address, send_address):
-        return setup_sockets_ipv6(receive_address, self.CLIENT_ACK_TIMEOUT, send_address)
+        return setup_sockets_ipv6(receive_address, 0, send_address)
 
 
 class ClientV4WithLag(ClientV4):
@@ -3,11 +3,12 @@
 # Data:           14.01.2022
 
 import logging
+import math
 import threading
 from _socket import IPPROTO_IPV6, IPV6_V6ONLY
-from socket import socket, AF_INET, SOCK_DGRAM, AF_INET6
+from socket import socket, AF_INET, SOCK_DGRAM, AF_INET6, SOL_SOCKET, SO_REUSEPORT
 from message import Message
-from time import time
+from time import time, monotonic
 
 
 class StoppableThread(threading.Thread):
@@ -35,8 +36,82 @@ class StoppableThread(threading.Thread):
             self.task()
 
 
-def setup_sockets_ipv4(receive_address, receive_timeout, send_address):
+class TimerWheel:
+    def __init__(self, tick: float, size: int = 512):
+        """
+        Hashed timing wheel. Timers are put into slots by their deadline, so scheduling and expiring
+        them takes constant time, no matter how many of them are waiting.
+
+        :param tick: time covered by one slot
+        :param size: number of slots, later timers wait for more turns of the wheel
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.current_slot = 0
+        self.current_time = monotonic()
+
+    def schedule(self, deadline: float, item):
+        # Rounding hides floating point errors, deadline exactly at the slot boundary can't move to the next one
+        ticks = max(1, math.ceil(round((deadline - self.current_time) / self.tick, 9)))
+        slot = (self.current_slot + ticks) % len(self.slots)
+        rounds = (ticks - 1) // len(self.slots)
+        self.slots[slot].append([rounds, item])
+
+    def advance(self, now: float) -> list:
+        expired = []
+        while self.current_time + self.tick <= now:
+            self.current_time += self.tick
+            self.current_slot = (self.current_slot + 1) % len(self.slots)
+            waiting = []
+            for timer in self.slots[self.current_slot]:
+                if timer[0] == 0:
+                    expired.append(timer[1])
+                else:
+                    timer[0] -= 1
+                    waiting.append(timer)
+            self.slots[self.current_slot] = waiting
+        return expired
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        """
+        Limits rate of sent data. Data can be sent while bucket has tokens, every sent byte takes one token
+        and bucket is refilled with rate tokens per second, up to burst. Message is sent even if there are
+        less tokens than its size and bucket goes into debt, so size of the next message doesn't have to be known.
+        Bucket can be shared by many threads.
+
+        :param rate: allowed rate in bytes per second
+        :param burst: how many bytes can be sent at once after a pause
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        # Time until data can be sent, 0 if it can be sent at once
+        with self.lock:
+            self.refill(now)
+            if self.tokens > 0:
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def consume(self, size: int):
+        with self.lock:
+            self.tokens -= size
+
+
+def setup_sockets_ipv4(receive_address, receive_timeout, send_address, reuse_port=False):
     receive_socket = socket(AF_INET, SOCK_DGRAM)
+    if reuse_port:
+        # Many processes can receive on the same port, system spreads clients between them
+        receive_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, True)
     receive_socket.bind(receive_address)
     receive_socket.settimeout(receive_timeout)
 
@@ -46,9 +121,11 @@ def setup_sockets_ipv4(receive_address, receive_timeout, send_address):
     return receive_socket, send_socket
 
 
-def setup_sockets_ipv6(receive_address, receive_timeout, send_address):
+def setup_sockets_ipv6(receive_address, receive_timeout, send_address, reuse_port=False):
     receive_socket = socket(AF_INET6, SOCK_DGRAM)
     receive_socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, True)
+    if reuse_port:
+        receive_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, True)
     receive_socket.bind(receive_address)
     receive_socket.settimeout(receive_timeout)
 
@@ -59,21 +136,48 @@ def setup_sockets_ipv6(receive_address, receive_timeout, send_address):
     return receive_socket, send_socket
 
 
-def send_message(send_socket: socket, message: Message, address: tuple[str, int], logger):
-    logger.debug(f"SEND: {message}")
-    send_socket.sendto(message.pack(), address)
-
-
-def receive_message(receive_socket: socket, logger) -> tuple[Message, tuple[str, int]]:
-    binary_data, address = receive_socket.recvfrom(Message.MAX_MESSAGE_SIZE)
+class MessageBuffer:
+    def __init__(self, size: int = Message.MAX_MESSAGE_SIZE):
+        """
+        Preallocated buffer for one message, reused by every send or receive on a socket.
+        Data of message received into the buffer is its view, it's valid only until the next receive.
+
+        :param size: size of the buffer, max size of a message by default
+        """
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+
+
+def send_message(send_socket: socket, message: Message, address: tuple[str, int], logger,
+                 buffer: MessageBuffer = None):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"SEND: {message}")
+    if buffer is None:
+        send_socket.sendto(message.pack(), address)
+    else:
+        size = message.pack_into(buffer.view)
+        send_socket.sendto(buffer.view[:size], address)
+
+
+def receive_message(receive_socket: socket, logger,
+                    buffer: MessageBuffer = None) -> tuple[Message, tuple[str, int]]:
+    if buffer is None:
+        binary_data, address = receive_socket.recvfrom(Message.MAX_MESSAGE_SIZE)
+    else:
+        size, address = receive_socket.recvfrom_into(buffer.data)
+        binary_data = buffer.view[:size]
     message = Message.unpack(binary_data)
-    logger.debug(f'RECV: {message}, lag = {time() - message.timestamp:.2f}')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'RECV: {message}, lag = {time() - message.timestamp:.2f}')
     return message, address
 
 
 def setup_loggers(logging_level: int):
     logger = logging.getLogger(__name__)
     logger.setLevel(logging_level)
+    if logger.handlers:
+        # Logger is shared by every server and client, one handler writes each line once
+        return logger
     log_format = '%(threadName)12s:%(levelname)8s %(message)s'
     stderr_handler = logging.StreamHandler()
     stderr_handler.setFormatter(logging.Formatter(log_format))
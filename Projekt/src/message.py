@@ -5,6 +5,7 @@
 import struct
 import hashlib
 import time
+import zlib
 from enum import Enum
 
 
@@ -15,95 +16,194 @@ class MessageType(Enum):
     ACK = 0b00001000
     FIN = 0b00010000
     INF = 0b00100000
+    PRB = 0b01000000
+    SKP = 0b10000000
+    # Values with one bit are used up
+    PAR = 0b00000011
 
 
 class ErrorType(Enum):
     STREAM_NOT_FOUND = 1
+    HASH_NOT_SUPPORTED = 2
+    RANGE_NOT_SATISFIABLE = 3
+    TOO_MANY_CHANNELS = 4
+
+
+class HashType(Enum):
+    SHA3 = 0
+    BLAKE2B = 1
+    CRC32 = 2
+    NONE = 3
+
+    def digest(self, data: bytes) -> bytes:
+        return DIGESTS[self](data)
+
+    @property
+    def size(self) -> int:
+        return DIGEST_SIZES[self]
+
+
+CRC = struct.Struct("!I")
+DIGESTS = {
+    HashType.SHA3: lambda data: hashlib.sha3_256(data).digest(),
+    HashType.BLAKE2B: lambda data: hashlib.blake2b(data, digest_size=16).digest(),
+    HashType.CRC32: lambda data: CRC.pack(zlib.crc32(data)),
+    HashType.NONE: lambda data: b"",
+}
+DIGEST_SIZES = {HashType.SHA3: 32, HashType.BLAKE2B: 16, HashType.CRC32: 4, HashType.NONE: 0}
 
 
 class Message:
+    __slots__ = ("message_type", "identifier", "size", "data", "timestamp", "hash_type", "channel",
+                 "_data_hash", "_packed")
+
     MAX_HEADER_SIZE = 48
-    MAX_DATA_SIZE = 400
-    MAX_MESSAGE_SIZE = MAX_HEADER_SIZE + MAX_DATA_SIZE
+    MAX_DATA_SIZE = 400         # Default size of data, it's used when path wasn't probed
+    MAX_PAYLOAD_SIZE = 8192     # Upper limit of data size, which can be chosen by probing the path
+    MAX_MESSAGE_SIZE = MAX_HEADER_SIZE + MAX_PAYLOAD_SIZE
+    MAX_CHANNELS = 8            # How many streams can be sent in one session
+
+    # Formats are compiled once, not for every packed message
+    SHORT_HEADER = struct.Struct("!BihBd")
+    RECEIVED_HEADER = struct.Struct("!BIHBd")
+    INT = struct.Struct("i")
+    LONG = struct.Struct("=q")
+    TYPES = {message_type.value: message_type for message_type in MessageType}
+    HASH_TYPES = {hash_type.value: hash_type for hash_type in HashType}
 
     def __init__(self,
                  message_type: MessageType,
                  identifier: int,
                  size: int = 0,
                  data: bytes = b"",
-                 timestamp: int = None,
-                 data_hash: bytes = None):
-        """
-        +-----+------+---+---+---+---+---+---+---+
-        |     |   0  | 1 | 2 | 3 | 4 | 5 | 6 | 7 |
-        +-----+------+---+---+---+---+---+---+---+
-        |  0  | TYPE |   IDENTIFIER  |   |   |   |
-        +-----+------+---------------+-------+---+
-        |  8  |             TIMESTAMP            |
-        +-----+----------------------------------+
-        |  16 |               SHA-3              |
-        +-----+----------------------------------+
-        |                   ...                  |
-        +-----+----------------------------------+
-        |  40 |               SHA-3              |
-        +-----+----------------------------------+
-        |  48 |               DATA               |
-        +-----+----------------------------------+
-        |                   ...                  |
-        +-----+----------------------------------+
-        | 448 |               DATA               |
-        +-----+----------------------------------+
-        """
-        self.hash_algorithm = hashlib.sha3_256()
+                 timestamp: float = None,
+                 data_hash: bytes = None,
+                 hash_type: HashType = HashType.SHA3,
+                 channel: int = 0):
+        """
+        +-----+------+---+---+---+---+---+---+------+
+        |     |   0  | 1 | 2 | 3 | 4 | 5 | 6 |   7  |
+        +-----+------+---+---+---+---+---+---+------+
+        |  0  | TYPE |   IDENTIFIER  | SIZE  | FLAG |
+        +-----+------+---------------+-------+------+
+        |  8  |               TIMESTAMP             |
+        +-----+-------------------------------------+
+        |  16 |          HASH (0 - 32 bytes)        |
+        +-----+-------------------------------------+
+        |                    ...                    |
+        +-----+-------------------------------------+
+        |  H  |                 DATA                |
+        +-----+-------------------------------------+
+        |                    ...                    |
+        +-----+-------------------------------------+
+
+        Lower half of byte 7 tells which hash protects data, header is as long as it needs: 48 bytes with SHA-3,
+        32 with BLAKE2b, 20 with CRC32 and 16 without hash. Messages without data have no hash.
+        Upper half of byte 7 is channel, number of the stream in session. Each channel has its own identifiers.
+        """
         self.message_type = message_type
         self.identifier = identifier
         self.size = size
         if timestamp is None:
-            self.timestamp = int(time.time())
+            self.timestamp = time.time()
         else:
             self.timestamp = timestamp
         self.data = data[:Message.MAX_MESSAGE_SIZE]
-        if data_hash is None:
-            self.hash_algorithm.update(data)
-            self.data_hash = self.hash_algorithm.digest()
-        else:
-            self.data_hash = data_hash
+        self.hash_type = hash_type
+        self.channel = channel
+        # Hash is computed only when it's needed, messages without data never need it
+        self._data_hash = data_hash
+        self._packed = None
+
+    @property
+    def data_hash(self) -> bytes:
+        if self._data_hash is None:
+            self._data_hash = self.hash_type.digest(self.data)
+        return self._data_hash
+
+    def freeze(self):
+        """
+        Packs message once, every later pack() returns the same bytes. Frozen message (flyweight)
+        can be sent many times without building it again, but its timestamp doesn't change.
+        """
+        self._packed = self.pack()
+        return self
+
+    def pack_header(self) -> bytes:
+        return Message.SHORT_HEADER.pack(self.message_type.value,
+                                         self.identifier,
+                                         self.size,
+                                         self.channel << 4 | self.hash_type.value,
+                                         self.timestamp)
 
     def pack(self) -> bytes:
+        if self._packed is not None:
+            return self._packed
         if self.size != 0:
-            return struct.pack(f"!Bihxq32s{self.size}s",
-                               self.message_type.value,
-                               self.identifier,
-                               self.size,
-                               self.timestamp,
-                               self.data_hash,
-                               self.data)
+            # Data can be a view of bigger buffer (e.g. memory mapped file), it's copied only once here
+            return b"".join((self.pack_header(), self.data_hash, self.data))
         else:
-            return struct.pack(f"!Bihxq",
-                               self.message_type.value,
-                               self.identifier,
-                               self.size,
-                               self.timestamp)
+            return self.pack_header()
+
+    def pack_into(self, buffer: memoryview) -> int:
+        """
+        Packs message into existing buffer, so the same buffer can be used for every sent message.
+
+        :param buffer: writable buffer, at least MAX_MESSAGE_SIZE long
+        :return: size of packed message
+        """
+        if self._packed is not None:
+            buffer[:len(self._packed)] = self._packed
+            return len(self._packed)
+        Message.SHORT_HEADER.pack_into(buffer, 0,
+                                       self.message_type.value,
+                                       self.identifier,
+                                       self.size,
+                                       self.channel << 4 | self.hash_type.value,
+                                       self.timestamp)
+        if self.size == 0:
+            return Message.SHORT_HEADER.size
+        data_start = Message.SHORT_HEADER.size + self.hash_type.size
+        buffer[Message.SHORT_HEADER.size:data_start] = self.data_hash
+        end = data_start + len(self.data)
+        buffer[data_start:end] = self.data
+        return end
 
     @staticmethod
     def unpack(binary_data: bytes):
-        type_value, identifier, size, timestamp = struct.unpack(f"!BIHxq", binary_data[:16])
-        message_type = MessageType(type_value)
+        """
+        Data and hash are sliced from binary_data, when it's a memoryview (e.g. receive buffer)
+        data of the message is a view of it and it's valid only as long as the buffer isn't reused.
+        """
+        type_value, identifier, size, flags, timestamp = Message.RECEIVED_HEADER.unpack_from(binary_data)
+        message_type = Message.TYPES[type_value]
+        hash_type = Message.HASH_TYPES[flags & 0x0F]
 
         data_hash = b""
         data = b""
         if size != 0:
-            data_hash, data = struct.unpack(f"!16x32s{size}s", binary_data)
+            data_start = Message.SHORT_HEADER.size + hash_type.size
+            data_hash = bytes(binary_data[Message.SHORT_HEADER.size:data_start])
+            data = binary_data[data_start:data_start + size]
 
-        return Message(message_type, identifier, size, data, timestamp, data_hash)
+        return Message(message_type, identifier, size, data, timestamp, data_hash, hash_type, flags >> 4)
 
     def check_hash(self) -> bool:
-        self.hash_algorithm.update(self.data)
-        return self.hash_algorithm.digest() == self.data_hash
+        if self.size == 0:
+            # Empty messages (keep alive) are sent without hash
+            return True
+        return self.hash_type.digest(self.data) == self.data_hash
 
     def data_to_int(self, idx: int = 0) -> int:
-        idx = idx * 4
-        return struct.unpack(f"i", self.data[idx:idx+4])[0]
+        return Message.INT.unpack_from(self.data, idx * 4)[0]
+
+    def data_to_long(self, idx: int = 0) -> int:
+        return Message.LONG.unpack_from(self.data, idx * 4)[0]
+
+    def data_to_bitmap(self, offset: int = 0) -> list[int]:
+        return [offset + byte_idx * 8 + bit
+                for byte_idx, byte in enumerate(self.data)
+                for bit in range(8) if byte & (1 << bit)]
 
     def __repr__(self):
         human_time = time.asctime(time.localtime(self.timestamp))
@@ -111,30 +211,164 @@ class Message:
 
 
 class RequestMessage(Message):
-    def __init__(self, identifier: int, port: int):
-        super().__init__(MessageType.REQ, identifier, 4, struct.pack("i", port))
+    __slots__ = ()
+
+    DATA = struct.Struct("iiii")
+    STREAM = struct.Struct("i")
+    RANGE = struct.Struct("=qq")
+    # Flags in the third byte of options
+    HAS_RANGE = 1
+    MAX_FEC_GROUP = 0xFF
+
+    def __init__(self, identifier: int, port: int, window_size: int = 1, hash_type: HashType = HashType.SHA3,
+                 max_payload_size: int = Message.MAX_DATA_SIZE, streams: list[int] = (), fec_group: int = 0,
+                 start: int = 0, length: int = -1):
+        """
+        Lower byte of the third number (options) is hash type, the next one is size of parity group
+        and the third one has flags. When HAS_RANGE flag is set, range of the first stream is at the end.
+
+        :param identifier: identifier of requested stream
+        :param port: port, where server should send data
+        :param window_size: how many messages of one stream client can hold (receive window)
+        :param hash_type: hash which should protect data in this session
+        :param max_payload_size: biggest data client can receive in one message, path is probed up to it
+        :param streams: identifiers of other streams sent in the same session, in channels 1, 2, ...
+        :param fec_group: after how many data messages server sends parity message, 0 without parity
+        :param start: offset of the first requested byte of the first stream
+        :param length: number of requested bytes of the first stream, -1 for everything after start
+        """
+        if not 0 <= fec_group <= RequestMessage.MAX_FEC_GROUP:
+            raise ValueError(f"Size of parity group has to be between 0 and {RequestMessage.MAX_FEC_GROUP}")
+        has_range = start != 0 or length >= 0
+        flags = RequestMessage.HAS_RANGE if has_range else 0
+        # Every field has its own byte, too big value can't change the next one
+        options = hash_type.value & 0xFF | (fec_group & 0xFF) << 8 | (flags & 0xFF) << 16
+        data = b"".join((RequestMessage.DATA.pack(port, window_size, options, max_payload_size),
+                         *(RequestMessage.STREAM.pack(stream) for stream in streams),
+                         RequestMessage.RANGE.pack(start, length) if has_range else b""))
+        super().__init__(MessageType.REQ, identifier, len(data), data)
 
 
 class ErrorMessage(Message):
+    __slots__ = ()
+
     def __init__(self, error: ErrorType):
         super().__init__(MessageType.ERR, error.value)
 
 
 class DataMessage(Message):
-    def __init__(self, identifier: int, data=b""):
-        super().__init__(MessageType.MSG, identifier, len(data), data)
+    __slots__ = ()
+
+    def __init__(self, identifier: int, data=b"", hash_type: HashType = HashType.SHA3, data_hash: bytes = None):
+        super().__init__(MessageType.MSG, identifier, len(data), data, data_hash=data_hash, hash_type=hash_type)
 
 
 class InfoMessage(Message):
-    def __init__(self, identifier: int, port: int):
-        super().__init__(MessageType.INF, identifier, 4, struct.pack("i", port))
+    __slots__ = ()
+
+    DATA = struct.Struct("=iqqq")
+
+    def __init__(self, identifier: int, port: int, stream_size: int = -1, total_size: int = None, version: int = 0):
+        """
+        :param identifier: message identifier
+        :param port: port, where client should send ACKs
+        :param stream_size: size of the requested part of stream in bytes, -1 if it's unknown
+        :param total_size: size of the whole stream, the same as stream_size if whole stream is requested
+        :param version: version of stream content (e.g. modification time of file), 0 if it's unknown
+        """
+        total_size = stream_size if total_size is None else total_size
+        super().__init__(MessageType.INF, identifier, InfoMessage.DATA.size,
+                         InfoMessage.DATA.pack(port, stream_size, total_size, version))
 
 
 class ACKMessage(Message):
-    def __init__(self, identifier: int):
-        super().__init__(MessageType.ACK, identifier)
+    __slots__ = ()
+
+    def __init__(self, identifier: int, received: list[int] = (), timestamp: float = None,
+                 hash_type: HashType = HashType.SHA3, channel: int = 0):
+        """
+        Confirms every message up to identifier (cumulative ACK). Messages received after a gap
+        are confirmed selectively with bitmap in data, bit i stands for message identifier + 1 + i.
+
+        :param identifier: last message received in order
+        :param received: identifiers of messages received out of order
+        :param timestamp: timestamp of the last received message, it lets the server measure round trip time
+        :param hash_type: hash negotiated for the session
+        :param channel: channel of confirmed messages
+        """
+        bitmap = bytearray()
+        for idx in received:
+            bit = idx - identifier - 1
+            if bit >= 0:
+                if bit // 8 >= len(bitmap):
+                    bitmap.extend(bytes(bit // 8 - len(bitmap) + 1))
+                bitmap[bit // 8] |= 1 << (bit % 8)
+        super().__init__(MessageType.ACK, identifier, len(bitmap), bytes(bitmap), timestamp, hash_type=hash_type,
+                         channel=channel)
+
+
+class ProbeMessage(Message):
+    __slots__ = ()
+
+    def __init__(self, payload_size: int, padding: bool = True, hash_type: HashType = HashType.SHA3):
+        """
+        Server checks with probes how big messages can get to the client. Client confirms each
+        received probe with empty probe of the same identifier.
+
+        :param payload_size: tested size of data, it's also identifier of the probe
+        :param padding: probe is filled with payload_size bytes, confirmation is empty
+        :param hash_type: hash negotiated for the session
+        """
+        data = bytes(payload_size) if padding else b""
+        super().__init__(MessageType.PRB, payload_size, len(data), data, hash_type=hash_type)
+
+
+class SkipMessage(Message):
+    __slots__ = ()
+
+    DATA = struct.Struct("i")
+
+    def __init__(self, identifier: int, skip_to: int, hash_type: HashType = HashType.SHA3):
+        """
+        Announces that messages before skip_to, which weren't received yet, won't be sent anymore.
+
+        :param identifier: message identifier, announcement is sent in order like data
+        :param skip_to: identifier of the first message, which can still come
+        :param hash_type: hash negotiated for the session
+        """
+        super().__init__(MessageType.SKP, identifier, 4, SkipMessage.DATA.pack(skip_to), hash_type=hash_type)
+
+
+class ParityMessage(Message):
+    __slots__ = ()
+
+    DATA = struct.Struct("HH")
+
+    def __init__(self, identifier: int, count: int, size_parity: int, parity: bytes,
+                 hash_type: HashType = HashType.SHA3):
+        """
+        XOR of data of count data messages following identifier, client can rebuild one of them, when it's lost.
+        Parity isn't confirmed and it's never sent again.
+
+        :param identifier: identifier of the first protected message
+        :param count: number of protected messages
+        :param size_parity: XOR of sizes of protected data
+        :param parity: XOR of protected data, shorter data are padded with zeros
+        """
+        data = ParityMessage.DATA.pack(count, size_parity) + parity
+        super().__init__(MessageType.PAR, identifier, len(data), data, hash_type=hash_type)
 
 
 class QuitMessage(Message):
+    __slots__ = ()
+
     def __init__(self, identifier: int):
         super().__init__(MessageType.FIN, identifier)
+
+
+# Control messages which are always the same are packed only once
+QUIT_MESSAGE = QuitMessage(1).freeze()
+STREAM_NOT_FOUND_MESSAGE = ErrorMessage(ErrorType.STREAM_NOT_FOUND).freeze()
+HASH_NOT_SUPPORTED_MESSAGE = ErrorMessage(ErrorType.HASH_NOT_SUPPORTED).freeze()
+RANGE_NOT_SATISFIABLE_MESSAGE = ErrorMessage(ErrorType.RANGE_NOT_SATISFIABLE).freeze()
+TOO_MANY_CHANNELS_MESSAGE = ErrorMessage(ErrorType.TOO_MANY_CHANNELS).freeze()
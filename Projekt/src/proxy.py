@@ -0,0 +1,219 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import heapq
+import logging
+import random
+import selectors
+import socket
+from time import monotonic
+from message import Message, MessageType
+from common import setup_loggers, StoppableThread
+
+
+class NetworkConditions:
+    def __init__(self,
+                 loss: float = 0,
+                 duplication: float = 0,
+                 reordering: float = 0,
+                 delay: float = 0,
+                 jitter: float = 0,
+                 reorder_delay: float = 0.005,
+                 bandwidth: float = None,
+                 seed: int = None):
+        """
+        Impairments of emulated network, applied to every datagram independently.
+
+        :param loss: probability that datagram is lost
+        :param duplication: probability that datagram is delivered twice
+        :param reordering: probability that datagram is held back, so the next ones overtake it
+        :param delay: constant one-way delay in seconds
+        :param jitter: random delay added to every datagram, up to this value
+        :param reorder_delay: how long reordered datagram is held back
+        :param bandwidth: capacity of the link in bytes per second, None if unlimited
+        :param seed: seed of random decisions, the same seed gives the same decisions for the same traffic
+        """
+        self.loss = loss
+        self.duplication = duplication
+        self.reordering = reordering
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_delay = reorder_delay
+        self.bandwidth = bandwidth
+        self.seed = seed
+
+
+class Link:
+    def __init__(self, conditions: NetworkConditions, seed):
+        """
+        One direction of emulated network. It has its own random generator, so decisions in one direction
+        don't depend on the traffic in the other one.
+        """
+        self.conditions = conditions
+        self.random = random.Random(seed)
+        self.free_at = 0
+        self.stats = {"forwarded": 0, "lost": 0, "duplicated": 0, "reordered": 0}
+
+    def schedule(self, size: int, now: float) -> list[float]:
+        # Returns delivery times of all copies of the datagram, empty list if it's lost
+        conditions = self.conditions
+        if self.random.random() < conditions.loss:
+            self.stats["lost"] += 1
+            return []
+        copies = 1
+        if self.random.random() < conditions.duplication:
+            self.stats["duplicated"] += 1
+            copies = 2
+
+        deliveries = []
+        for _ in range(copies):
+            departure = now
+            if conditions.bandwidth:
+                # Datagrams wait in queue of the link until the previous ones are sent
+                self.free_at = max(self.free_at, now) + size / conditions.bandwidth
+                departure = self.free_at
+            delay = conditions.delay + self.random.uniform(0, conditions.jitter)
+            if self.random.random() < conditions.reordering:
+                self.stats["reordered"] += 1
+                delay += conditions.reorder_delay
+            deliveries.append(departure + delay)
+        self.stats["forwarded"] += copies
+        return deliveries
+
+
+class Route:
+    def __init__(self, client_address: tuple, ip_address: str, family: int):
+        """
+        Path of one client through the proxy. Server sends data to the proxy instead of the client
+        and client sends ACKs to the proxy instead of the session.
+
+        :param client_address: address, where client receives data
+        """
+        self.client_address = client_address
+        self.session_address = None
+        self.server_socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.server_socket.bind((ip_address, 0))
+        self.client_socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.client_socket.bind((ip_address, 0))
+
+    def close(self):
+        self.server_socket.close()
+        self.client_socket.close()
+
+
+class LossyProxy:
+    def __init__(self,
+                 server_address: tuple,
+                 conditions: NetworkConditions = None,
+                 receive_address: tuple = None,
+                 logging_level: int = logging.INFO):
+        """
+        UDP proxy emulating bad network between clients and server on one machine. Clients send requests
+        to the proxy instead of the server. Ports of request and info messages are replaced with ports
+        of the proxy, so all data and ACKs of the session pass through it and are impaired on the way.
+        Requests aren't impaired, clients don't repeat them.
+
+        :param server_address: address, where server receives requests
+        :param conditions: impairments of the network, ideal network by default
+        :param receive_address: address, where proxy receives requests, any port on loopback by default
+        """
+        self.logger = setup_loggers(logging_level)
+        self.conditions = conditions or NetworkConditions()
+        self.server_address = server_address
+        self.family = socket.AF_INET6 if ":" in server_address[0] else socket.AF_INET
+        self.ip_address = "::1" if self.family == socket.AF_INET6 else "127.0.0.1"
+
+        self.receive_socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        self.receive_socket.bind(receive_address or (self.ip_address, 0))
+        self.receive_address = self.receive_socket.getsockname()
+
+        # Seeds of both directions come from one seed, so the whole run can be repeated
+        seeds = random.Random(self.conditions.seed)
+        self.downlink = Link(self.conditions, seeds.random())
+        self.uplink = Link(self.conditions, seeds.random())
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.receive_socket, selectors.EVENT_READ, self.handle_request)
+        self.routes = {}
+        self.queue = []
+        self.sequence = 0
+        self.main_thread = None
+
+    def start(self):
+        self.main_thread = StoppableThread(self.receive)
+
+    def stop(self):
+        if self.main_thread is not None:
+            self.main_thread.stop()
+            self.main_thread.join()
+        for route in self.routes.values():
+            self.selector.unregister(route.server_socket)
+            self.selector.unregister(route.client_socket)
+            route.close()
+        self.routes = {}
+        self.receive_socket.close()
+        self.selector.close()
+
+    def receive(self):
+        # Loop wakes up when the next datagram should be delivered, stop is checked at least every 100 ms
+        timeout = 0.1
+        if self.queue:
+            timeout = min(timeout, max(0, self.queue[0][0] - monotonic()))
+        for key, _ in self.selector.select(timeout):
+            data, address = key.fileobj.recvfrom(Message.MAX_MESSAGE_SIZE)
+            key.data(data, address)
+        self.deliver(monotonic())
+
+    def deliver(self, now: float):
+        while self.queue and self.queue[0][0] <= now:
+            _, _, send_socket, data, address = heapq.heappop(self.queue)
+            try:
+                send_socket.sendto(data, address)
+            except OSError:
+                # Route was closed or receiver is gone, datagram is lost like in real network
+                pass
+
+    def forward(self, link: Link, send_socket: socket.socket, data: bytes, address: tuple):
+        for delivery in link.schedule(len(data), monotonic()):
+            # Sequence number keeps order of datagrams with the same delivery time
+            heapq.heappush(self.queue, (delivery, self.sequence, send_socket, data, address))
+            self.sequence += 1
+
+    @staticmethod
+    def replace_port(message: Message, port: int) -> bytes:
+        # Port is the first number in data of request and info messages
+        data = Message.INT.pack(port) + bytes(message.data[Message.INT.size:])
+        return Message(message.message_type, message.identifier, message.size, data, message.timestamp,
+                       hash_type=message.hash_type, channel=message.channel).pack()
+
+    def handle_request(self, data: bytes, address: tuple):
+        message = Message.unpack(data)
+        if message.message_type != MessageType.REQ:
+            return
+        route = self.routes.get(address[:2])
+        if route is None:
+            route = Route((address[0], message.data_to_int()), self.ip_address, self.family)
+            self.routes[address[:2]] = route
+            self.selector.register(route.server_socket, selectors.EVENT_READ,
+                                   lambda data, _: self.handle_server_message(route, data))
+            self.selector.register(route.client_socket, selectors.EVENT_READ,
+                                   lambda data, _: self.handle_client_message(route, data))
+            self.logger.info(f"Route of {route.client_address} through {route.server_socket.getsockname()}")
+        route.server_socket.sendto(self.replace_port(message, route.server_socket.getsockname()[1]),
+                                   self.server_address)
+
+    def handle_server_message(self, route: Route, data: bytes):
+        message = Message.unpack(data)
+        if message.message_type == MessageType.INF:
+            # ACKs are sent to the proxy, which knows where the session is
+            route.session_address = (self.server_address[0], message.data_to_int())
+            data = self.replace_port(message, route.client_socket.getsockname()[1])
+        self.forward(self.downlink, route.client_socket, data, route.client_address)
+
+    def handle_client_message(self, route: Route, data: bytes):
+        if route.session_address is not None:
+            self.forward(self.uplink, route.server_socket, data, route.session_address)
+
+    def get_stats(self) -> dict:
+        return {"downlink": dict(self.downlink.stats), "uplink": dict(self.uplink.stats)}
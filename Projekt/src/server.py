@@ -2,40 +2,39 @@
 # Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
 # Data:           14.01.2022
 
+import multiprocessing
+import os
+import selectors
 import signal
 import socket
+import struct
 import logging
-from queue import Empty
+import threading
 from select import select
-from message import Message, DataMessage, QuitMessage, InfoMessage, MessageType, ErrorMessage, ErrorType
-from streams import File, Stream, Ping
-from common import setup_loggers, StoppableThread, send_message, receive_message, setup_sockets_ipv4, setup_sockets_ipv6
-from netaddr import IPAddress
+from time import monotonic, process_time
+from message import Message, MessageType, HashType, RequestMessage, STREAM_NOT_FOUND_MESSAGE, \
+    HASH_NOT_SUPPORTED_MESSAGE, RANGE_NOT_SATISFIABLE_MESSAGE, TOO_MANY_CHANNELS_MESSAGE
+from streams import File, Stream, StreamReader, Ping
+from session import Session
+from common import setup_loggers, StoppableThread, TimerWheel, TokenBucket, send_message, receive_message, \
+    setup_sockets_ipv4, setup_sockets_ipv6
+from netaddr import IPAddress, AddrFormatError
 import CONFIG as CFG
 
 
-class CommunicationThreadV4(StoppableThread):
-    def __init__(self, stream: Stream, address, logger, server_ip_address="::"):
-        self.logger = logger
-
-        self.CLIENT_NOT_RESPONDING_TIMEOUT = CFG.CLIENT_NOT_RESPONDING_TIMEOUT
-        self.NEXT_MESSAGE_TIMEOUT = CFG.NEXT_MESSAGE_TIMEOUT
-        self.SERVER_ACK_TIMEOUT = CFG.SERVER_ACK_TIMEOUT
-        self.client_lag = 0
-
+class CommunicationThreadV4(Session, StoppableThread):
+    def __init__(self, streams: list[StreamReader], address, logger, server_ip_address="::", window_size: int = 1,
+                 hash_type: HashType = HashType.SHA3, max_payload_size: int = Message.MAX_DATA_SIZE,
+                 pacer: TokenBucket = None, fec_group: int = 0):
         self.receive_socket, self.receive_port, self.send_socket, self.send_port = self.setup_sockets(server_ip_address)
-
-        self.stream = stream
-        self.message_idx = 0
-        self.address = address
-        self.client_connected = True
-
-        super().__init__()
+        Session.__init__(self, streams, address, logger, self.send_socket, self.receive_port, window_size, hash_type,
+                         max_payload_size, pacer, fec_group)
+        StoppableThread.__init__(self)
 
     def setup_sockets(self, ip_address):
         receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         receive_socket.bind((ip_address, 0))
-        receive_socket.settimeout(self.SERVER_ACK_TIMEOUT)
+        receive_socket.settimeout(CFG.SERVER_ACK_TIMEOUT)
         receive_port = receive_socket.getsockname()[1]
 
         send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -44,66 +43,40 @@ class CommunicationThreadV4(StoppableThread):
 
         return receive_socket, receive_port, send_socket, send_port
 
-    def get_next_message(self):
-        try:
-            # I'm trying to get next message
-            data = self.stream.get_next_message(self.NEXT_MESSAGE_TIMEOUT)
-            if data is not None:
-                return DataMessage(self.message_idx, data)
-            else:
-                return None
-        except Empty:
-            # There is no available message, I need to keep connection alive
-            return DataMessage(self.message_idx)
-
     def run(self):
-        message = InfoMessage(self.message_idx, self.receive_port)
-        while not self.stopped():
-            send_message(self.send_socket, message, self.address, self.logger)
-            if self.confirm():
-                break
+        self.open()
+        while not self.stopped() and self.client_connected and not self.is_open():
+            self.confirm()
 
-        message = self.get_next_message()
-        while not self.stopped() and message is not None and self.client_connected:
-            send_message(self.send_socket, message, self.address, self.logger)
-            if self.confirm():
-                message = self.get_next_message()
+        while not self.stopped() and self.client_connected:
+            self.fill_window()
+            if self.is_finished():
+                break
+            self.confirm()
 
-        self.stream.close()
-        self.logger.info("Transmission ended")
-        if self.client_connected:
-            send_message(self.send_socket, QuitMessage(1), self.address, self.logger)
+        self.close()
 
     def confirm(self) -> bool:
+        # Session waiting for rate limits wakes up, when it can send again, even if ACK isn't late
+        timeout = self.rtt.timeout
+        if self.paced_until is not None:
+            # Zero timeout would make the socket non-blocking, time which is already over gets the shortest wait
+            timeout = min(timeout, max(CFG.SERVER_MIN_ACK_TIMEOUT, self.paced_until - monotonic()))
+        self.receive_socket.settimeout(timeout)
         try:
-            while True:
-                # Waiting for ACK
-                message, _ = receive_message(self.receive_socket, self.logger)
-                if message.message_type == MessageType.ACK:
-                    ACK_id = message.identifier
-                    if self.message_idx == ACK_id:
-                        self.message_idx += 1
-                        self.client_lag = 0
+            while self.client_connected:
+                # Waiting for ACK, malformed datagram doesn't stop the session
+                try:
+                    message, _ = receive_message(self.receive_socket, self.logger)
+                    if self.handle_message(message):
                         return True
-                elif message.message_type == MessageType.FIN:
-                    self.logger.info("Client closed connection")
-                    self.client_connected = False
-                    return False
+                except Server.INVALID_MESSAGE_ERRORS as error:
+                    self.logger.warning(f"Invalid message dropped: {error!r}")
         except socket.timeout:
-            # Timeout, I need to send another message
-            self.client_lag = self.client_lag + self.SERVER_ACK_TIMEOUT
-            self.readjust_timeout(self.client_lag)
-            if self.client_lag >= self.CLIENT_NOT_RESPONDING_TIMEOUT:
-                self.logger.info("Client not responding: timeout")
-                self.client_connected = False
-            return False
-
-    def readjust_timeout(self, lag):
-        if lag > self.SERVER_ACK_TIMEOUT:
-            self.logger.info(f"Readjusting ACK timeout "
-                             f"{self.SERVER_ACK_TIMEOUT}->{self.SERVER_ACK_TIMEOUT * 2}")
-            self.SERVER_ACK_TIMEOUT *= 2
-            self.receive_socket.settimeout(self.SERVER_ACK_TIMEOUT)
+            deadline = self.next_timeout()
+            if self.paced_until is None or deadline is not None and deadline <= monotonic():
+                self.handle_timeout()
+        return False
 
 
 class CommunicationThreadV6(CommunicationThreadV4):
@@ -114,7 +87,7 @@ class CommunicationThreadV6(CommunicationThreadV4):
         receive_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
         receive_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, True)
         receive_socket.bind((ip_address, 0, 0, 0))
-        receive_socket.settimeout(self.SERVER_ACK_TIMEOUT)
+        receive_socket.settimeout(CFG.SERVER_ACK_TIMEOUT)
         receive_port = receive_socket.getsockname()[1]
 
         send_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
@@ -131,18 +104,25 @@ class Server:
                  ipv4_send_address: tuple[str, int] = ("", 0),
                  ipv6_receive_address: tuple[str, int, int, int] = ("", 0, 0, 0),
                  ipv6_send_address: tuple[str, int, int, int] = ("", 0, 0, 0),
-                 logging_level: int = logging.INFO):
+                 logging_level: int = logging.INFO,
+                 reuse_port: bool = False,
+                 rate_limit: float = None):
+        """
+        :param rate_limit: max rate of data (bytes per second) sent by all sessions together, None if it isn't limited
+        """
         self.logger = setup_loggers(logging_level)
         self.setup_exit_handler()
 
         self.sockets = []
 
-        self.ipv4_receive_socket, self.ipv4_send_socket = setup_sockets_ipv4(ipv4_receive_address, 1, ipv4_send_address)
+        self.ipv4_receive_socket, self.ipv4_send_socket = setup_sockets_ipv4(ipv4_receive_address, 1, ipv4_send_address,
+                                                                             reuse_port)
         self.ipv4_receive_address = self.ipv4_receive_socket.getsockname()
         self.logger.info(f"Server IPv4 bound on: {self.ipv4_receive_address}")
         self.sockets.append(self.ipv4_receive_socket)
 
-        self.ipv6_receive_socket, self.ipv6_send_socket = setup_sockets_ipv6(ipv6_receive_address, 1, ipv6_send_address)
+        self.ipv6_receive_socket, self.ipv6_send_socket = setup_sockets_ipv6(ipv6_receive_address, 1, ipv6_send_address,
+                                                                             reuse_port)
         self.ipv6_receive_address = self.ipv6_receive_socket.getsockname()
         self.logger.info(f"Server IPv6 bound on: {self.ipv6_receive_address}")
         self.sockets.append(self.ipv6_receive_socket)
@@ -151,6 +131,12 @@ class Server:
         self.main_thread = None
         self.streams = {}
         self.threads = []
+        self.pacer = None
+        if rate_limit:
+            self.pacer = TokenBucket(rate_limit, rate_limit * CFG.SERVER_PACING_BURST)
+
+    # Anyone can send datagram to the server, malformed one (too short, unknown type or hash) is dropped
+    INVALID_MESSAGE_ERRORS = (struct.error, KeyError, ValueError, IndexError)
 
     def register_stream(self, idx: int, stream: Stream):
         self.streams[idx] = stream
@@ -181,36 +167,389 @@ class Server:
     def receive(self):
         ready_sockets, _, _ = select(self.sockets, [], [], 1)
         for ready_socket in ready_sockets:
-            message, address = receive_message(ready_socket, self.logger)
-            if message.message_type == MessageType.REQ:
-                self.logger.info(f"Client request from {address}, stream idx: {message.identifier}")
-                ip_address, *_ = address
-                address = (ip_address, message.data_to_int())
+            try:
+                message, address = receive_message(ready_socket, self.logger)
+                self.handle_message(message, address)
+            except Server.INVALID_MESSAGE_ERRORS as error:
+                self.logger.warning(f"Invalid message dropped: {error!r}")
+
+    def handle_message(self, message: Message, request_address: tuple):
+        if message.message_type == MessageType.REQ:
+            options = message.data_to_int(2) if message.size >= 12 else HashType.SHA3.value
+            hash_value = options & 0xFF
+            fec_group = options >> 8 & 0xFF
+            flags = options >> 16 & 0xFF
+
+            # Range of the first stream is at the end, other streams requested in the same session are before it
+            end = message.size
+            data_range = (0, -1)
+            if flags & RequestMessage.HAS_RANGE:
+                end -= RequestMessage.RANGE.size
+                data_range = RequestMessage.RANGE.unpack_from(message.data, end)
+            stream_ids = [message.identifier] + [message.data_to_int(idx) for idx in range(4, end // 4)]
+            self.logger.info(f"Client request from {request_address}, stream idx: {stream_ids}")
+            ip_address, *_ = request_address
+            address = (ip_address, message.data_to_int())
+            # Data can't be sent to invalid address, such request isn't even answered
+            try:
                 ip_version = IPAddress(ip_address).version
-
-                if message.identifier in self.streams.keys():
-                    self.logger.info(f"Sending stream {message.identifier} to {address}")
-                    self.create_new_thread(message.identifier, address, ip_version)
-                else:
-                    self.send_error(ErrorMessage(ErrorType.STREAM_NOT_FOUND), address)
-
-    def create_new_thread(self, stream_idx: int, address: tuple, version: int):
-        stream = self.streams[stream_idx]
-        stream.prepare()
+            except AddrFormatError:
+                self.logger.warning(f"Request from invalid address {request_address} dropped")
+                return
+            if not 0 < address[1] <= 0xFFFF:
+                self.logger.warning(f"Request from {request_address} with invalid port {address[1]} dropped")
+                return
+
+            # Older clients don't announce their window, they can only handle stop-and-wait
+            window_size = message.data_to_int(1) if message.size >= 8 else 1
+            window_size = min(window_size, CFG.SERVER_WINDOW_SIZE)
+            max_payload_size = message.data_to_int(3) if message.size >= 16 else Message.MAX_DATA_SIZE
+
+            if hash_value not in Message.HASH_TYPES:
+                self.send_error(HASH_NOT_SUPPORTED_MESSAGE, address)
+            elif len(stream_ids) > Message.MAX_CHANNELS:
+                self.send_error(TOO_MANY_CHANNELS_MESSAGE, address)
+            elif all(idx in self.streams for idx in stream_ids):
+                self.logger.info(f"Sending streams {stream_ids} to {address}")
+                self.create_new_thread(stream_ids, address, ip_version, window_size, request_address,
+                                       Message.HASH_TYPES[hash_value], max_payload_size, fec_group, data_range)
+            else:
+                self.send_error(STREAM_NOT_FOUND_MESSAGE, address)
+
+    def open_streams(self, stream_ids: list[int], address: tuple, data_range: tuple[int, int] = (0, -1)):
+        # Every session gets its own readers, data of the streams is shared
+        streams = [self.streams[idx].open() for idx in stream_ids]
+        if data_range != (0, -1) and not streams[0].seek(*data_range):
+            for stream in streams:
+                stream.close()
+            self.send_error(RANGE_NOT_SATISFIABLE_MESSAGE, address)
+            return None
+        return streams
+
+    def create_new_thread(self, stream_ids: list[int], address: tuple, version: int, window_size: int = 1,
+                          request_address: tuple = None, hash_type: HashType = HashType.SHA3,
+                          max_payload_size: int = Message.MAX_DATA_SIZE, fec_group: int = 0,
+                          data_range: tuple[int, int] = (0, -1)):
+        streams = self.open_streams(stream_ids, address, data_range)
+        if streams is None:
+            return
 
         if version == 4:
-            communication_thread = CommunicationThreadV4(stream=stream,
+            communication_thread = CommunicationThreadV4(streams=streams,
                                                          address=address,
                                                          logger=self.logger,
-                                                         server_ip_address=self.ipv4_receive_address[0])
+                                                         server_ip_address=self.ipv4_receive_address[0],
+                                                         window_size=window_size,
+                                                         hash_type=hash_type,
+                                                         max_payload_size=max_payload_size,
+                                                         pacer=self.pacer,
+                                                         fec_group=fec_group)
         else:
-            communication_thread = CommunicationThreadV6(stream=stream,
+            communication_thread = CommunicationThreadV6(streams=streams,
                                                          address=address,
                                                          logger=self.logger,
-                                                         server_ip_address=self.ipv6_receive_address[0])
+                                                         server_ip_address=self.ipv6_receive_address[0],
+                                                         window_size=window_size,
+                                                         hash_type=hash_type,
+                                                         max_payload_size=max_payload_size,
+                                                         pacer=self.pacer,
+                                                         fec_group=fec_group)
         self.threads.append(communication_thread)
 
 
+class EventLoopServer(Server):
+    def __init__(self, **kwargs):
+        """
+        Server which drives all sessions from one thread. Requests and ACKs of every client come to one
+        socket per address family and are matched with sessions by client address. Retransmissions
+        are timed with timer wheel instead of socket timeouts.
+        """
+        super().__init__(**kwargs)
+        self.TIMER_TICK = CFG.SERVER_TIMER_TICK
+        self.selector = selectors.DefaultSelector()
+        for receive_socket in self.sockets:
+            receive_socket.setblocking(False)
+            self.selector.register(receive_socket, selectors.EVENT_READ)
+
+        # Producers of live streams wake up sessions waiting for data from other threads
+        self.wakeup_socket, self.wakeup_sender = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_socket, selectors.EVENT_READ, self.wake_sessions)
+        self.woken_sessions = set()
+        self.woken_lock = threading.Lock()
+
+        self.timers = TimerWheel(self.TIMER_TICK)
+        self.deadlines = {}
+        self.sessions = {}
+        self.closed_sessions = 0
+        self.closed_sent_messages = 0
+        self.closed_retransmissions = 0
+        self.closed_parity_messages = 0
+
+    def stop(self):
+        super().stop()
+        if self.main_thread is not None and self.main_thread is not threading.current_thread():
+            self.main_thread.join()
+        for session in list(self.sessions.values()):
+            self.remove_session(session)
+        self.wakeup_socket.close()
+        self.wakeup_sender.close()
+
+    def receive(self):
+        # Without sessions there are no timers to check
+        timeout = self.TIMER_TICK if self.sessions else 1
+        for key, _ in self.selector.select(timeout):
+            if key.data is not None:
+                # Other source of events registered by the owner of the loop
+                key.data()
+            else:
+                self.receive_all(key.fileobj)
+        for session, deadline in self.timers.advance(monotonic()):
+            # Timer is outdated, when session was rescheduled or removed
+            if self.deadlines.get(session) == deadline:
+                del self.deadlines[session]
+                self.service(session)
+
+    def receive_all(self, receive_socket):
+        while True:
+            try:
+                message, address = receive_message(receive_socket, self.logger)
+                self.handle_message(message, address)
+            except BlockingIOError:
+                return
+            except Server.INVALID_MESSAGE_ERRORS as error:
+                self.logger.warning(f"Invalid message dropped: {error!r}")
+
+    def handle_message(self, message: Message, request_address: tuple):
+        session = self.sessions.get(request_address[:2])
+        if session is not None:
+            session.handle_message(message)
+            self.service(session)
+        else:
+            super().handle_message(message, request_address)
+
+    def create_new_thread(self, stream_ids: list[int], address: tuple, version: int, window_size: int = 1,
+                          request_address: tuple = None, hash_type: HashType = HashType.SHA3,
+                          max_payload_size: int = Message.MAX_DATA_SIZE, fec_group: int = 0,
+                          data_range: tuple[int, int] = (0, -1)):
+        streams = self.open_streams(stream_ids, address, data_range)
+        if streams is None:
+            return
+        if version == 4:
+            send_socket, ack_port = self.ipv4_send_socket, self.ipv4_receive_address[1]
+        else:
+            send_socket, ack_port = self.ipv6_send_socket, self.ipv6_receive_address[1]
+
+        session = Session(streams, address, self.logger, send_socket, ack_port, window_size, hash_type,
+                          max_payload_size, self.pacer, fec_group)
+        for stream in streams:
+            stream.listener = lambda: self.notify(session)
+        session.request_address = request_address[:2]
+        self.sessions[session.request_address] = session
+        session.open()
+        self.schedule(session)
+
+    def service(self, session: Session):
+        timeout = session.next_timeout()
+        if timeout is not None and timeout <= monotonic():
+            session.handle_timeout()
+        if session.client_connected and session.is_open():
+            session.fill_window(block=False)
+
+        if session.is_finished():
+            self.remove_session(session)
+        else:
+            self.schedule(session)
+
+    def notify(self, session: Session):
+        # Called by producer thread, loop is woken up once for all sessions which got data in the meantime
+        with self.woken_lock:
+            # Loop is already woken up, when any session (also this one) waits for it
+            pending = bool(self.woken_sessions)
+            self.woken_sessions.add(session)
+            if pending:
+                return
+        try:
+            self.wakeup_sender.send(b"\0")
+        except OSError:
+            # Loop is already woken up (buffer is full) or the server is stopped
+            pass
+
+    def wake_sessions(self):
+        try:
+            while self.wakeup_socket.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        with self.woken_lock:
+            sessions, self.woken_sessions = self.woken_sessions, set()
+        for session in sessions:
+            # Session could be closed before its producer noticed it
+            if self.sessions.get(session.request_address) is session:
+                self.service(session)
+
+    def schedule(self, session: Session):
+        # Session waiting only for stream data is parked, producer wakes it up with notify().
+        # It still needs to wake up for keepalive, so client doesn't consider it dead.
+        deadlines = [deadline for deadline in (session.next_timeout(), session.next_send(), session.next_keepalive())
+                     if deadline is not None]
+        if not deadlines:
+            return
+        deadline = min(deadlines)
+        scheduled = self.deadlines.get(session)
+        if scheduled is None or deadline < scheduled:
+            self.deadlines[session] = deadline
+            self.timers.schedule(deadline, (session, deadline))
+
+    def remove_session(self, session: Session):
+        self.sessions.pop(session.request_address, None)
+        self.deadlines.pop(session, None)
+        session.close()
+        self.closed_sessions += 1
+        self.closed_sent_messages += session.sent_messages
+        self.closed_retransmissions += session.retransmissions
+        self.closed_parity_messages += session.parity_messages
+
+    def get_stats(self) -> dict:
+        sessions = list(self.sessions.values())
+        return {"active_sessions": len(sessions),
+                "closed_sessions": self.closed_sessions,
+                "sent_messages": self.closed_sent_messages + sum(session.sent_messages for session in sessions),
+                "retransmissions": self.closed_retransmissions + sum(session.retransmissions for session in sessions),
+                "parity_messages": self.closed_parity_messages + sum(session.parity_messages for session in sessions),
+                "cpu_time": process_time()}
+
+
+def run_worker(worker_idx: int, ipv4_receive_address: tuple, ipv6_receive_address: tuple, streams: dict,
+               connection, logging_level: int, rate_limit: float = None):
+    server = EventLoopServer(ipv4_receive_address=ipv4_receive_address,
+                             ipv6_receive_address=ipv6_receive_address,
+                             logging_level=logging_level,
+                             reuse_port=True,
+                             rate_limit=rate_limit)
+    for idx, stream in streams.items():
+        server.register_stream(idx, stream)
+
+    def handle_command():
+        command, *args = connection.recv()
+        if command == "register":
+            server.register_stream(*args)
+            connection.send(("registered", worker_idx))
+        elif command == "stats":
+            connection.send(("stats", server.get_stats()))
+        elif command == "stop":
+            server.stop()
+
+    # Commands from supervisor are handled by the same loop as clients
+    server.selector.register(connection, selectors.EVENT_READ, handle_command)
+    connection.send(("ready", worker_idx))
+    server.start(thread=False)
+
+
+class MultiProcessServer:
+    def __init__(self,
+                 ipv4_receive_address: tuple[str, int] = ("", 0),
+                 ipv6_receive_address: tuple[str, int, int, int] = ("", 0, 0, 0),
+                 workers: int = None,
+                 logging_level: int = logging.INFO,
+                 rate_limit: float = None):
+        """
+        Server running sessions in many worker processes, so it isn't limited to one core. Every worker runs
+        EventLoopServer bound to the same ports with SO_REUSEPORT and the system spreads clients between them.
+        Supervisor only starts workers and passes streams and commands to them. Files are memory mapped
+        by every worker, so they share one copy of data.
+
+        :param workers: number of worker processes, number of cores by default
+        :param rate_limit: max rate of data (bytes per second) sent by all workers, every worker gets equal part
+        """
+        self.logger = setup_loggers(logging_level)
+        self.logging_level = logging_level
+        self.setup_exit_handler()
+
+        self.WORKERS = workers or os.cpu_count()
+        self.WORKER_TIMEOUT = CFG.SERVER_WORKER_TIMEOUT
+        self.WORKER_RATE_LIMIT = rate_limit / self.WORKERS if rate_limit else None
+        self.ipv4_receive_address = self.choose_address(socket.AF_INET, ipv4_receive_address)
+        self.ipv6_receive_address = self.choose_address(socket.AF_INET6, ipv6_receive_address)
+        self.logger.info(f"Server IPv4 bound on: {self.ipv4_receive_address}")
+        self.logger.info(f"Server IPv6 bound on: {self.ipv6_receive_address}")
+
+        self.context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        self.streams = {}
+        self.is_running = False
+
+    @staticmethod
+    def choose_address(family: int, address: tuple) -> tuple:
+        # Workers need to know the port before they bind, when any port is allowed it's chosen here
+        with socket.socket(family, socket.SOCK_DGRAM) as probe_socket:
+            if family == socket.AF_INET6:
+                probe_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, True)
+            probe_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
+            probe_socket.bind(address)
+            return probe_socket.getsockname()
+
+    def setup_exit_handler(self):
+        signal.signal(signal.SIGINT, lambda sig, frame: self.stop())
+
+    def register_stream(self, idx: int, stream: Stream):
+        self.streams[idx] = stream
+        # Stream has to be available in every worker before any client asks for it
+        self.send_command("register", idx, stream)
+
+    def send_command(self, *command) -> list:
+        for connection in self.connections:
+            connection.send(command)
+        return [self.receive_answer(connection) for connection in self.connections]
+
+    def receive_answer(self, connection):
+        if not connection.poll(self.WORKER_TIMEOUT):
+            raise TimeoutError("Worker not responding")
+        _, answer = connection.recv()
+        return answer
+
+    def start(self, thread=True):
+        for worker_idx in range(self.WORKERS):
+            connection, worker_connection = self.context.Pipe()
+            process = self.context.Process(target=run_worker,
+                                           args=(worker_idx, self.ipv4_receive_address, self.ipv6_receive_address,
+                                                 self.streams, worker_connection, self.logging_level,
+                                                 self.WORKER_RATE_LIMIT),
+                                           daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.is_running = True
+
+        # Requests can't be sent before workers bind their sockets
+        for connection in self.connections:
+            self.receive_answer(connection)
+        self.logger.info(f"Started {self.WORKERS} workers")
+
+        if not thread:
+            for process in self.processes:
+                process.join()
+
+    def stop(self):
+        self.is_running = False
+        for connection in self.connections:
+            connection.send(("stop",))
+        for process in self.processes:
+            process.join(self.WORKER_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.connections = []
+        self.processes = []
+
+    def get_stats(self) -> dict:
+        workers = self.send_command("stats")
+        total = {key: sum(stats[key] for stats in workers) for key in (workers[0] if workers else {})}
+        total["workers"] = workers
+        return total
+
+
 if __name__ == '__main__':
     server = Server(
         ipv4_receive_address=("127.0.0.1", 8801),
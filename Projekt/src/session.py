@@ -0,0 +1,559 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+from queue import Empty
+from socket import socket
+from time import monotonic, time
+from message import Message, DataMessage, InfoMessage, ProbeMessage, SkipMessage, ParityMessage, MessageType, \
+    HashType, QUIT_MESSAGE
+from streams import StreamReader
+from common import send_message, TokenBucket
+import CONFIG as CFG
+
+
+class PendingMessage:
+    def __init__(self, message: Message):
+        """
+        Message sent to the client, which is still waiting for confirmation (ACK).
+
+        :param message: sent message
+        """
+        self.message = message
+        self.sent_at = 0
+        self.retransmissions = 0
+        # Messages sent after this one and confirmed before it, message is lost when there are too many of them
+        self.overtaken = 0
+
+
+class RTTEstimator:
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    CLOCK_GRANULARITY = 0.001
+
+    def __init__(self, timeout: float, min_timeout: float, max_timeout: float):
+        """
+        Estimates round trip time and computes ACK timeout from it as described in RFC 6298.
+        Timeout is doubled after every retransmission and recomputed with the next valid measurement.
+
+        :param timeout: initial ACK timeout
+        :param min_timeout: lower limit of ACK timeout
+        :param max_timeout: upper limit of ACK timeout
+        """
+        self.MIN_TIMEOUT = min_timeout
+        self.MAX_TIMEOUT = max_timeout
+        self.timeout = timeout
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.backoffs = 0
+
+    def update(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+        self.set_timeout(self.srtt + max(self.CLOCK_GRANULARITY, 4 * self.rttvar))
+
+    def backoff(self):
+        self.backoffs += 1
+        self.set_timeout(self.timeout * 2)
+
+    def set_timeout(self, timeout: float):
+        self.timeout = min(max(timeout, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+
+    def stats(self) -> dict:
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "timeout": self.timeout,
+                "samples": self.samples, "backoffs": self.backoffs}
+
+    def __repr__(self):
+        return f"RTT {self.srtt}, variance {self.rttvar}, timeout {self.timeout}"
+
+
+class CongestionController:
+    def __init__(self, initial_window: int, min_window: int, max_window: int):
+        """
+        NewReno-like congestion window, in messages. In slow start the window grows by one message for every
+        confirmed message, in congestion avoidance by one message per window (additive increase).
+        Loss found from ACKs halves the window (multiplicative decrease), timeout drops it to the minimum.
+        Messages sent before the last decrease belong to the same congestion event, their losses are ignored
+        and their ACKs don't grow the window (recovery).
+
+        :param initial_window: window at the start of session
+        :param min_window: lower limit of window
+        :param max_window: upper limit of window, the biggest window client can accept
+        """
+        self.MIN_WINDOW = min_window
+        self.MAX_WINDOW = max_window
+        self.window = min(max(initial_window, min_window), max_window)
+        self.ssthresh = max_window
+        self.recovery_point = 0
+        self.losses = 0
+        self.timeouts = 0
+
+    def get_window(self) -> int:
+        return int(self.window)
+
+    def confirm(self, count: int, sent_at: float):
+        if sent_at <= self.recovery_point:
+            return
+        if self.window < self.ssthresh:
+            self.window += count
+        else:
+            self.window += count / self.window
+        self.window = min(self.window, self.MAX_WINDOW)
+
+    def lose(self, sent_at: float, now: float):
+        if sent_at <= self.recovery_point:
+            return
+        self.losses += 1
+        self.ssthresh = max(self.window / 2, self.MIN_WINDOW)
+        self.window = self.ssthresh
+        self.recovery_point = now
+
+    def timeout(self, now: float):
+        self.timeouts += 1
+        self.ssthresh = max(self.window / 2, self.MIN_WINDOW)
+        self.window = self.MIN_WINDOW
+        self.recovery_point = now
+
+    def stats(self) -> dict:
+        return {"window": self.window, "ssthresh": self.ssthresh, "losses": self.losses, "timeouts": self.timeouts}
+
+
+class ParityEncoder:
+    def __init__(self, group_size: int):
+        """
+        Computes XOR of data of consecutive data messages. Client can rebuild one lost message of every group
+        without waiting for retransmission.
+
+        :param group_size: number of data messages protected by one parity message
+        """
+        self.GROUP_SIZE = group_size
+        self.first = None
+        self.count = 0
+        self.parity = 0
+        self.size_parity = 0
+        self.max_size = 0
+
+    def add(self, message: Message) -> bool:
+        # Returns True, when the group is complete
+        if self.first is None:
+            self.first = message.identifier
+        self.count += 1
+        # Data is XORed as one big number, shorter data is padded with zeros at the end
+        self.parity ^= int.from_bytes(message.data, "little")
+        self.size_parity ^= message.size
+        self.max_size = max(self.max_size, message.size)
+        return self.count >= self.GROUP_SIZE
+
+    def flush(self, hash_type: HashType):
+        # Parity of messages added since the last one, None if there are no such messages
+        if self.first is None:
+            return None
+        message = ParityMessage(self.first, self.count, self.size_parity, self.parity.to_bytes(self.max_size, "little"),
+                                hash_type)
+        self.first = None
+        self.count = self.parity = self.size_parity = self.max_size = 0
+        return message
+
+
+class Channel:
+    def __init__(self, index: int, stream: StreamReader, fec_group: int = 0):
+        """
+        One stream sent in a session. Every channel has its own identifiers of messages and its own window,
+        so messages missing in one stream don't hold back the others.
+
+        :param index: number of the channel in session, it's carried by every message
+        :param stream: reader of transmitted stream
+        :param fec_group: number of data messages protected by one parity message, 0 without parity
+        """
+        self.index = index
+        self.stream = stream
+        self.WEIGHT = stream.get_weight()
+        self.MAX_AGE = stream.get_max_age()
+        # Rate limits of the channel, the stream's one and the server's one
+        self.pacers = []
+        if stream.get_rate():
+            self.pacers.append(TokenBucket(stream.get_rate(), stream.get_rate() * CFG.SERVER_PACING_BURST))
+
+        self.message_idx = 0
+        self.window = {}
+        self.last_sent = monotonic()
+        self.deficit = 0
+        self.end_of_stream = False
+        self.parity = ParityEncoder(fec_group) if fec_group > 0 else None
+
+    def is_open(self) -> bool:
+        # Data can't be sent until client confirms INF message
+        return self.message_idx > 0 and 0 not in self.window
+
+    def is_finished(self) -> bool:
+        return self.end_of_stream and not self.window
+
+
+class Session:
+    def __init__(self, streams: list[StreamReader], address, logger, send_socket: socket, ack_port: int,
+                 window_size: int = 1, hash_type: HashType = HashType.SHA3,
+                 max_payload_size: int = Message.MAX_DATA_SIZE, pacer: TokenBucket = None, fec_group: int = 0):
+        """
+        Server side of transmission of streams to one client. Session doesn't wait for anything,
+        it's driven by its owner: CommunicationThread with own sockets or EventLoopServer.
+        Every stream is sent in its own channel and channels take turns in the shared window.
+
+        :param streams: readers of transmitted streams, one for each channel
+        :param address: address where data is sent
+        :param logger: server logger
+        :param send_socket: socket used to send data
+        :param ack_port: port where client should send ACKs
+        :param window_size: how many messages of one stream can be sent without confirmation
+        :param hash_type: hash protecting data, chosen by the client
+        :param max_payload_size: biggest data client can receive, bigger messages than default are probed first
+        :param pacer: rate limit shared by all sessions of the server, None if it isn't limited
+        :param fec_group: after how many data messages parity message is sent, 0 without parity
+        """
+        self.logger = logger
+
+        self.CLIENT_NOT_RESPONDING_TIMEOUT = CFG.CLIENT_NOT_RESPONDING_TIMEOUT
+        self.NEXT_MESSAGE_TIMEOUT = CFG.NEXT_MESSAGE_TIMEOUT
+        self.IDLE_TIMEOUT = CFG.SERVER_TIMER_TICK
+        self.REORDER_THRESHOLD = CFG.SERVER_REORDER_THRESHOLD
+        self.rtt = RTTEstimator(CFG.SERVER_ACK_TIMEOUT, CFG.SERVER_MIN_ACK_TIMEOUT, CFG.SERVER_MAX_ACK_TIMEOUT)
+        self.WINDOW_SIZE = max(1, window_size)
+        self.SESSION_WINDOW_SIZE = max(self.WINDOW_SIZE, CFG.SERVER_WINDOW_SIZE)
+        self.HASH_TYPE = hash_type
+        self.PROBE_ATTEMPTS = CFG.SERVER_PROBE_ATTEMPTS
+        self.MAX_PROBES = CFG.SERVER_MAX_PROBES
+        self.MIN_PROBE_TIMEOUT = CFG.SERVER_MIN_PROBE_TIMEOUT
+        self.PROBE_PRECISION = CFG.SERVER_PROBE_PRECISION
+        self.client_lag = 0
+
+        self.congestion = CongestionController(CFG.SERVER_INITIAL_WINDOW, CFG.SERVER_MIN_WINDOW,
+                                               self.SESSION_WINDOW_SIZE)
+        self.channels = [Channel(idx, stream, fec_group) for idx, stream in enumerate(streams)]
+        self.FEC_GROUP = fec_group
+        if pacer is not None:
+            for channel in self.channels:
+                channel.pacers.append(pacer)
+        # Time when rate limits allow sending again, None if session isn't waiting for them
+        self.paced_until = None
+        self.send_socket = send_socket
+        self.ack_port = ack_port
+        self.sent_messages = 0
+        self.retransmissions = 0
+        self.skipped_messages = 0
+        self.parity_messages = 0
+        self.address = address
+        self.client_connected = True
+
+        # Data of every message (and header of parity) has to fit, client announcing less gets the default size
+        if max_payload_size <= ParityMessage.DATA.size:
+            max_payload_size = Message.MAX_DATA_SIZE
+        # Default size is safe, sizes from probe_limit up are assumed to be too big until probe confirms them
+        self.payload_size = min(Message.MAX_DATA_SIZE, max_payload_size)
+        self.probe_limit = min(max_payload_size, Message.MAX_PAYLOAD_SIZE) + 1
+        self.probe = None
+        self.probes = 0
+        if all(0 <= stream.get_size() <= self.get_data_size() for stream in streams):
+            # Whole streams fit in one message, probing would only delay them
+            self.probe_limit = self.payload_size + 1
+        for stream in streams:
+            stream.set_packet_size(self.get_data_size())
+
+    def open(self):
+        # Client needs to know where to send ACKs before data transmission starts
+        for channel in self.channels:
+            self.send_new(channel, InfoMessage(channel.message_idx, self.ack_port, channel.stream.get_size(),
+                                               channel.stream.get_total_size(), channel.stream.get_version()))
+
+    def is_open(self) -> bool:
+        return all(channel.is_open() for channel in self.channels)
+
+    def is_finished(self) -> bool:
+        return not self.client_connected or all(channel.is_finished() for channel in self.channels)
+
+    def in_flight(self) -> int:
+        return sum(len(channel.window) for channel in self.channels)
+
+    def close(self):
+        for channel in self.channels:
+            channel.stream.close()
+        self.logger.info("Transmission ended")
+        if self.client_connected:
+            self.send_message(QUIT_MESSAGE)
+
+    def fill_window(self, block: bool = True):
+        if self.is_probing():
+            if self.probe is None:
+                self.send_probe()
+            return
+        # Channels take turns (deficit round robin), in every turn channel can send data
+        # proportional to its weight, so big stream can't starve the others.
+        # Session can't send more than congestion window allows
+        self.paced_until = None
+        in_flight = self.in_flight()
+        window = self.congestion.get_window()
+        while in_flight < window:
+            sent = False
+            for channel in self.channels:
+                if channel.end_of_stream or len(channel.window) >= self.WINDOW_SIZE or not self.can_send(channel):
+                    continue
+                channel.deficit += channel.WEIGHT * self.payload_size
+                while channel.deficit > 0 and len(channel.window) < self.WINDOW_SIZE \
+                        and in_flight < window and self.can_send(channel):
+                    if not self.send_next(channel, block and in_flight == 0):
+                        # Channel without data can't save its turn for later
+                        channel.deficit = 0
+                        break
+                    in_flight += 1
+                    sent = True
+            if not sent:
+                return
+
+    def send_next(self, channel: Channel, block: bool) -> bool:
+        try:
+            # I'm trying to get next message, I can't wait for it if other messages need retransmission
+            # and one stream can't wait long, when other streams could have data
+            timeout = 0
+            if block:
+                timeout = self.NEXT_MESSAGE_TIMEOUT if len(self.channels) == 1 else self.IDLE_TIMEOUT
+            data = channel.stream.get_next_message(timeout)
+        except Empty:
+            # Stream has no data now, the last messages are protected without waiting for the whole group
+            self.send_parity(channel)
+            if not channel.window and monotonic() - channel.last_sent >= self.NEXT_MESSAGE_TIMEOUT:
+                # There is no available message, I need to keep connection alive
+                self.send_new(channel, DataMessage(channel.message_idx, hash_type=self.HASH_TYPE))
+                channel.deficit = 0
+                return True
+            return False
+        if data is None:
+            channel.end_of_stream = True
+            self.send_parity(channel)
+            return False
+        self.send_new(channel, DataMessage(channel.message_idx, data, self.HASH_TYPE,
+                                           channel.stream.get_digest(self.HASH_TYPE)))
+        channel.deficit -= len(data)
+        for pacer in channel.pacers:
+            pacer.consume(len(data))
+        return True
+
+    def can_send(self, channel: Channel) -> bool:
+        # Data waits until every rate limit of the channel allows it, retransmissions are never delayed
+        if not channel.pacers:
+            return True
+        now = monotonic()
+        delay = max(pacer.delay(now) for pacer in channel.pacers)
+        if delay == 0:
+            return True
+        if self.paced_until is None or now + delay < self.paced_until:
+            self.paced_until = now + delay
+        return False
+
+    def is_probing(self) -> bool:
+        return self.probe_limit - self.payload_size > self.PROBE_PRECISION and self.probes < self.MAX_PROBES
+
+    def send_probe(self):
+        # The biggest size is checked first, it's enough for most paths. Next sizes are found by binary search
+        if self.probes == 0:
+            size = self.probe_limit - 1
+        else:
+            size = (self.payload_size + self.probe_limit) // 2
+        self.probes += 1
+        self.probe = PendingMessage(ProbeMessage(size, hash_type=self.HASH_TYPE))
+        self.send_pending(self.probe)
+
+    def confirm_probe(self, size: int) -> bool:
+        if not self.payload_size < size < self.probe_limit:
+            return False
+        self.payload_size = size
+        if self.probe is not None and self.probe.message.identifier <= size:
+            self.probe = None
+        self.update_payload_size()
+        return True
+
+    def lose_probe(self):
+        if self.probe.retransmissions + 1 < self.PROBE_ATTEMPTS:
+            self.resend_pending(self.probe)
+            return
+        # Probe didn't get through (or it's too big to be sent at all), smaller messages have to be used
+        self.probe_limit = self.probe.message.identifier
+        self.probe = None
+        self.update_payload_size()
+
+    def update_payload_size(self):
+        if not self.is_probing():
+            self.probe = None
+            for channel in self.channels:
+                channel.stream.set_packet_size(self.get_data_size())
+            self.logger.info(f"Size of data in messages: {self.get_data_size()}")
+
+    def get_data_size(self) -> int:
+        # Parity message has to fit in probed size too, its data is longer than the longest protected data
+        if self.FEC_GROUP > 0:
+            return self.payload_size - ParityMessage.DATA.size
+        return self.payload_size
+
+    def probe_timeout(self) -> float:
+        return max(self.rtt.timeout, self.MIN_PROBE_TIMEOUT)
+
+    def send_new(self, channel: Channel, message: Message):
+        message.channel = channel.index
+        pending = PendingMessage(message)
+        channel.window[message.identifier] = pending
+        channel.message_idx += 1
+        channel.last_sent = monotonic()
+        self.send_pending(pending)
+        if channel.parity is not None:
+            # Parity protects consecutive data messages, other messages end the group
+            if message.message_type != MessageType.MSG or channel.parity.add(message):
+                self.send_parity(channel)
+
+    def send_parity(self, channel: Channel):
+        if channel.parity is None:
+            return
+        message = channel.parity.flush(self.HASH_TYPE)
+        if message is not None:
+            message.channel = channel.index
+            self.parity_messages += 1
+            self.send_message(message)
+
+    def send_pending(self, pending: PendingMessage):
+        pending.sent_at = monotonic()
+        pending.overtaken = 0
+        self.sent_messages += 1
+        self.send_message(pending.message)
+
+    def resend_pending(self, pending: PendingMessage):
+        pending.retransmissions += 1
+        self.retransmissions += 1
+        self.send_pending(pending)
+
+    def send_message(self, message: Message):
+        try:
+            send_message(self.send_socket, message, self.address, self.logger)
+        except OSError:
+            if message.message_type != MessageType.PRB:
+                raise
+            # Message bigger than the link allows can't leave the host, it's the same as lost probe
+
+    def skip_stale(self, channel: Channel):
+        # Old data isn't worth sending again, client is told to stop waiting for it instead
+        if channel.MAX_AGE is None:
+            return
+        oldest_allowed = time() - channel.MAX_AGE
+        stale = [idx for idx, pending in channel.window.items()
+                 if pending.message.message_type == MessageType.MSG and pending.message.timestamp < oldest_allowed]
+        if not stale:
+            return
+        # Messages are created in order, everything before the last stale message is stale too.
+        # Older announcements are replaced by the new one
+        skip_to = max(stale) + 1
+        for idx in [idx for idx in channel.window if idx < skip_to]:
+            del channel.window[idx]
+        self.skipped_messages += len(stale)
+        self.logger.debug(f"Skipping stale messages of channel {channel.index} before {skip_to}")
+        self.send_new(channel, SkipMessage(channel.message_idx, skip_to, self.HASH_TYPE))
+
+    def retransmit(self) -> bool:
+        now = monotonic()
+        expired = []
+        for channel in self.channels:
+            self.skip_stale(channel)
+            expired += [pending for pending in channel.window.values() if now - pending.sent_at >= self.rtt.timeout]
+        if not expired:
+            return False
+        # Timeout means congestion, only the oldest messages which fit in reduced window are sent again.
+        # The other ones are sent when ACKs show they are missing or when they expire again
+        self.congestion.timeout(now)
+        expired.sort(key=lambda pending: pending.sent_at)
+        for pending in expired[:self.congestion.get_window()]:
+            self.resend_pending(pending)
+        return True
+
+    def next_send(self):
+        # Time when session, which waits for rate limits, can send again
+        return self.paced_until
+
+    def next_keepalive(self):
+        # Time when channel waiting for stream data has to send empty message, so client knows session is alive
+        idle = [channel.last_sent for channel in self.channels if not channel.end_of_stream and not channel.window]
+        return min(idle) + self.NEXT_MESSAGE_TIMEOUT if idle else None
+
+    def next_timeout(self):
+        # Time when the oldest message needs retransmission, None if nothing waits for ACK
+        if self.probe is not None:
+            return self.probe.sent_at + self.probe_timeout()
+        sent_at = [pending.sent_at for channel in self.channels for pending in channel.window.values()]
+        if not sent_at:
+            return None
+        return min(sent_at) + self.rtt.timeout
+
+    def handle_message(self, message: Message) -> bool:
+        # Messages protected by other hash than the negotiated one are rejected
+        if message.message_type == MessageType.ACK and message.hash_type == self.HASH_TYPE and message.check_hash():
+            if message.channel < len(self.channels) and self.acknowledge(self.channels[message.channel], message):
+                self.client_lag = 0
+                return True
+        elif message.message_type == MessageType.PRB and message.hash_type == self.HASH_TYPE:
+            if self.confirm_probe(message.identifier):
+                self.client_lag = 0
+                return True
+        elif message.message_type == MessageType.FIN:
+            self.logger.info("Client closed connection")
+            self.client_connected = False
+        return False
+
+    def handle_timeout(self):
+        # Timeout, I need to send messages which weren't confirmed in time
+        self.client_lag = self.client_lag + self.rtt.timeout
+        if self.probe is not None and monotonic() - self.probe.sent_at >= self.probe_timeout():
+            self.lose_probe()
+        if self.retransmit():
+            self.rtt.backoff()
+        if self.client_lag >= self.CLIENT_NOT_RESPONDING_TIMEOUT:
+            self.logger.info("Client not responding: timeout")
+            self.client_connected = False
+
+    def acknowledge(self, channel: Channel, message: Message) -> bool:
+        # ACK confirms every message up to its identifier and selected messages after it
+        received = message.data_to_bitmap(message.identifier + 1)
+        confirmed = [idx for idx in channel.window if idx <= message.identifier]
+        confirmed += [idx for idx in received if idx in channel.window]
+        if not confirmed:
+            return False
+
+        self.measure_rtt(channel, confirmed, message.timestamp)
+        last_sent = max(channel.window[idx].sent_at for idx in confirmed)
+        selected = [(idx, channel.window[idx].sent_at) for idx in confirmed if idx > message.identifier]
+        for idx in confirmed:
+            del channel.window[idx]
+        self.congestion.confirm(len(confirmed), last_sent)
+
+        # Missing message is lost only when enough later messages overtook it, a few of them are just reordering
+        if received:
+            self.skip_stale(channel)
+            lost = []
+            for idx, pending in channel.window.items():
+                pending.overtaken += sum(1 for selected_idx, sent_at in selected
+                                         if selected_idx > idx and sent_at > pending.sent_at)
+                if pending.overtaken >= self.REORDER_THRESHOLD:
+                    lost.append(pending)
+            if lost:
+                # All losses found in one ACK are one congestion event
+                self.congestion.lose(min(pending.sent_at for pending in lost), monotonic())
+                for pending in lost:
+                    self.resend_pending(pending)
+        return True
+
+    def measure_rtt(self, channel: Channel, confirmed: list[int], timestamp: float):
+        # ACK carries timestamp of the message which caused it. Retransmitted messages
+        # are skipped, it isn't known which copy was received (Karn's algorithm)
+        for idx in confirmed:
+            pending = channel.window[idx]
+            if pending.retransmissions == 0 and pending.message.timestamp == timestamp:
+                self.rtt.update(time() - timestamp)
+                return
@@ -2,15 +2,244 @@
 # Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
 # Data:           14.01.2022
 
+import mmap
+import os
+import struct
 import threading
 import time
-from queue import Queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from itertools import repeat
+from multiprocessing import get_context
+from queue import Empty
+from message import HashType
+import CONFIG as CFG
 
 
-class Stream:
-    def __init__(self, packet_size=400):
-        self._message_size = packet_size
-        self.messages = Queue()
+class OverflowPolicy(Enum):
+    BLOCK = 1           # Producer waits until reader makes space
+    DROP_OLDEST = 2     # The oldest waiting message is removed
+    DROP_NEWEST = 3     # New message is rejected
+
+
+class MessageQueue:
+    def __init__(self, size: int, policy: OverflowPolicy):
+        """
+        Bounded queue of messages for one reader, so slow session can't make server memory grow.
+        When it's full, policy decides what happens with new message.
+
+        :param size: max number of waiting messages
+        :param policy: what happens when queue is full
+        """
+        self.size = size
+        self.policy = policy
+        self.messages = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, data: bytes) -> bool:
+        with self.condition:
+            if len(self.messages) >= self.size:
+                if self.policy == OverflowPolicy.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.policy == OverflowPolicy.DROP_OLDEST:
+                    self.messages.popleft()
+                    self.dropped += 1
+                else:
+                    self.condition.wait_for(lambda: len(self.messages) < self.size or self.closed)
+                    if self.closed:
+                        return False
+            self.messages.append(data)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout: float = None) -> bytes:
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.messages, timeout):
+                raise Empty
+            data = self.messages.popleft()
+            # Blocked producer can put next message
+            self.condition.notify_all()
+            return data
+
+    def empty(self) -> bool:
+        return not self.messages
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def digest_chunks(data, chunk_size: int, hash_type: HashType) -> bytes:
+    view = memoryview(data)
+    return b"".join(hash_type.digest(view[i:i + chunk_size]) for i in range(0, len(view), chunk_size))
+
+
+def digest_file_range(filename: str, start: int, size: int, chunk_size: int, hash_type: HashType) -> bytes:
+    # Worker process reads its part of the file on its own, data isn't sent between processes
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        return digest_chunks(file.read(size), chunk_size, hash_type)
+
+
+class Manifest:
+    HEADER = struct.Struct("!qqiB")
+
+    def __init__(self, version: tuple[int, int], chunk_size: int, hash_type: HashType, digests: bytes):
+        """
+        Digests of all chunks of a file, so sessions sending the same file don't hash the same data again.
+        Chunk idx starts at idx * chunk_size, its digest is at idx * hash_type.size in digests.
+
+        :param version: modification time (ns) and size of the file, manifest is valid only for them
+        :param chunk_size: size of data in one message
+        :param hash_type: hash of chunks
+        :param digests: concatenated digests of chunks
+        """
+        self.version = version
+        self.chunk_size = chunk_size
+        self.hash_type = hash_type
+        self.digests = digests
+
+    def __len__(self) -> int:
+        return len(self.digests) // self.hash_type.size
+
+    def get_offset(self, idx: int) -> int:
+        return idx * self.chunk_size
+
+    def get_digest(self, idx: int) -> bytes:
+        size = self.hash_type.size
+        return self.digests[idx * size:(idx + 1) * size]
+
+    @staticmethod
+    def compute(filename: str, data, version: tuple[int, int], chunk_size: int, hash_type: HashType,
+                workers: int = 0):
+        """
+        :param filename: path to the file, workers read it instead of getting data
+        :param data: content of the file
+        :param workers: number of processes hashing parts of big files, 0 if file is hashed in this process
+        """
+        if workers > 1 and len(data) >= CFG.MANIFEST_PARALLEL_SIZE:
+            # Every part starts at the beginning of a chunk
+            part = (len(data) // workers // chunk_size + 1) * chunk_size
+            # Server has many threads, so workers are started clean instead of forking them
+            with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as executor:
+                digests = b"".join(executor.map(digest_file_range, repeat(filename), range(0, len(data), part),
+                                                repeat(part), repeat(chunk_size), repeat(hash_type)))
+        else:
+            digests = digest_chunks(data, chunk_size, hash_type)
+        return Manifest(version, chunk_size, hash_type, digests)
+
+    @staticmethod
+    def get_path(filename: str, chunk_size: int, hash_type: HashType) -> str:
+        return f"{filename}.{hash_type.name.lower()}-{chunk_size}{CFG.MANIFEST_SUFFIX}"
+
+    @staticmethod
+    def load(filename: str, version: tuple[int, int], chunk_size: int, hash_type: HashType):
+        # Index saved for other version of the file is stale, it's recognised by modification time and size
+        try:
+            with open(Manifest.get_path(filename, chunk_size, hash_type), 'rb') as file:
+                header = file.read(Manifest.HEADER.size)
+                digests = file.read()
+        except OSError:
+            return None
+        if len(header) != Manifest.HEADER.size \
+                or Manifest.HEADER.unpack(header) != (*version, chunk_size, hash_type.value):
+            return None
+        manifest = Manifest(version, chunk_size, hash_type, digests)
+        if len(manifest) != (version[1] + chunk_size - 1) // chunk_size:
+            return None
+        return manifest
+
+    def save(self, filename: str) -> bool:
+        # Index is replaced at once, other process never reads half of it
+        path = Manifest.get_path(filename, self.chunk_size, self.hash_type)
+        temporary_path = f"{path}.{os.getpid()}"
+        try:
+            with open(temporary_path, 'wb') as file:
+                file.write(Manifest.HEADER.pack(*self.version, self.chunk_size, self.hash_type.value))
+                file.write(self.digests)
+            os.replace(temporary_path, path)
+        except OSError:
+            # Manifest is still used, it's only computed again by the next server
+            return False
+        return True
+
+
+class StreamReader:
+    def __init__(self, stream):
+        """
+        Cursor of one session over shared stream, every session reads the whole stream on its own.
+
+        :param stream: stream which is read
+        """
+        self.stream = stream
+        self.packet_size = stream.get_packet_size()
+        # Called by producer of live stream when new data is available, so session waiting for it is woken up
+        self.listener = None
+
+    def get_next_message(self, timeout):
+        return None
+
+    def get_size(self) -> int:
+        return self.stream.get_size()
+
+    def get_total_size(self) -> int:
+        # Size of the whole stream, also when reader is limited to its part
+        return self.stream.get_size()
+
+    def get_version(self) -> int:
+        return self.stream.get_version()
+
+    def get_dropped(self) -> int:
+        return 0
+
+    def get_digest(self, hash_type: HashType):
+        # Digest of the last message, if it's known without hashing, None otherwise
+        return None
+
+    def get_max_age(self):
+        return self.stream.get_max_age()
+
+    def get_weight(self) -> int:
+        return self.stream.get_weight()
+
+    def get_rate(self):
+        return self.stream.get_rate()
+
+    def set_packet_size(self, packet_size: int):
+        # Session can send bigger messages when its path allows it, readers of live streams get whole messages
+        self.packet_size = packet_size
+
+    def seek(self, start: int, length: int = -1) -> bool:
+        # Only streams with random access can be read from the middle
+        return False
+
+    def close(self):
+        self.stream.release(self)
+
+
+class QueueReader(StreamReader):
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.messages = MessageQueue(*stream.get_queue_settings())
+
+    def put(self, data: bytes) -> bool:
+        added = self.messages.put(data)
+        if self.listener is not None:
+            self.listener()
+        return added
+
+    def get_dropped(self) -> int:
+        return self.messages.dropped
+
+    def close(self):
+        # Producer can't wait for a reader, which won't read anymore
+        self.messages.close()
+        super().close()
 
     def get_next_message(self, timeout):
         if self.messages.empty():
@@ -18,9 +247,153 @@ class Stream:
         else:
             return self.messages.get(timeout=timeout)
 
+
+class LiveReader(QueueReader):
+    def get_next_message(self, timeout):
+        # Live stream never ends, reader waits for next message
+        return self.messages.get(timeout=timeout)
+
+
+class FileReader(StreamReader):
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.start = 0
+        self.end = None
+        self.position = 0
+        self.last_position = 0
+
+    def get_next_message(self, timeout):
+        if self.position >= self.get_end():
+            return None
+        chunk = self.stream.get_range(self.position, min(self.packet_size, self.get_end() - self.position))
+        self.last_position = self.position
+        self.position += len(chunk)
+        return chunk
+
+    def get_digest(self, hash_type: HashType):
+        # Session doesn't wait for manifest, messages are hashed one by one until it's built
+        manifest = self.stream.get_manifest(self.packet_size, hash_type, block=False)
+        if manifest is None or self.last_position % self.packet_size != 0:
+            return None
+        if self.position - self.last_position < self.packet_size and self.position < self.stream.get_size():
+            # End of the range cuts the chunk, digest of the whole chunk doesn't match
+            return None
+        return manifest.get_digest(self.last_position // self.packet_size)
+
+    def get_end(self) -> int:
+        return self.stream.get_size() if self.end is None else self.end
+
+    def get_size(self) -> int:
+        # Client gets size of the requested range, so it knows when the transfer is complete
+        return self.get_end() - self.start
+
+    def seek(self, start: int, length: int = -1) -> bool:
+        """
+        Limits reader to the range of the file. Ranges starting at the border of a chunk keep whole chunks
+        in messages, so digests from the manifest can still be used.
+
+        :param start: offset of the first byte
+        :param length: number of bytes, -1 for everything after start
+        """
+        size = self.stream.get_size()
+        if start < 0 or start > size:
+            return False
+        self.start = self.position = self.last_position = start
+        self.end = size if length < 0 else min(size, start + length)
+        return True
+
+
+class Stream:
+    def __init__(self, packet_size=400, queue_size: int = CFG.STREAM_QUEUE_SIZE,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST, max_age: float = None,
+                 weight: int = 1, rate: float = None):
+        """
+        Source of data shared by all sessions. Each session reads it with its own reader, created by open().
+        Stream is prepared when the first reader is opened and closed when the last one is released.
+
+        :param packet_size: max size of data in one message
+        :param queue_size: how many messages of live stream can wait for one reader
+        :param overflow_policy: what happens with messages, when reader doesn't keep up
+        :param max_age: messages older than this (in seconds) aren't retransmitted, None if data never gets stale
+        :param weight: share of session window, which stream gets when it's sent with other streams
+        :param rate: max rate of data (bytes per second) sent to one session, None if it isn't limited
+        """
+        self._message_size = packet_size
+        self._queue_size = queue_size
+        self._overflow_policy = overflow_policy
+        self._max_age = max_age
+        self._weight = weight
+        self._rate = rate
+        self._dropped = 0
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def open(self) -> StreamReader:
+        reader = self.create_reader()
+        with self._readers_lock:
+            self._readers.append(reader)
+            if len(self._readers) == 1:
+                self.prepare()
+        return reader
+
+    def release(self, reader: StreamReader):
+        with self._readers_lock:
+            if reader in self._readers:
+                self._readers.remove(reader)
+                self._dropped += reader.get_dropped()
+                if not self._readers:
+                    self.close()
+
+    def create_reader(self) -> StreamReader:
+        return QueueReader(self)
+
+    def __getstate__(self):
+        # Readers belong to sessions of this process, copy of the stream (e.g. in worker process) starts without them
+        state = self.__dict__.copy()
+        del state["_readers"], state["_readers_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def get_packet_size(self) -> int:
+        return self._message_size
+
+    def get_max_age(self):
+        return self._max_age
+
+    def get_weight(self) -> int:
+        return self._weight
+
+    def get_rate(self):
+        return self._rate
+
+    def get_queue_settings(self) -> tuple[int, OverflowPolicy]:
+        return self._queue_size, self._overflow_policy
+
+    def get_dropped(self) -> int:
+        # Messages, which were dropped for any reader, including closed ones
+        return self._dropped + sum(reader.get_dropped() for reader in self.get_readers())
+
+    def get_readers(self) -> list[StreamReader]:
+        with self._readers_lock:
+            return list(self._readers)
+
     def fill_queue(self, data: bytes):
+        readers = self.get_readers()
         for i in range(0, len(data), self._message_size):
-            self.messages.put(data[i:i + self._message_size])
+            for reader in readers:
+                reader.put(data[i:i + self._message_size])
+
+    def get_size(self) -> int:
+        # Size of infinite streams is unknown
+        return -1
+
+    def get_version(self) -> int:
+        # Client resuming download checks it, data of other version can't be joined with saved one
+        return 0
 
     def prepare(self):
         pass
@@ -30,43 +403,145 @@ class Stream:
 
 
 class File(Stream):
-    def __init__(self, filename, packet_size=400):
-        super().__init__(packet_size)
-        with open(filename, 'rb') as file:
-            self._binary_data = file.read()
+    def __init__(self, filename, packet_size=400, use_mmap=False, use_manifest=False, manifest_workers=0, **kwargs):
+        """
+        Stream of file content. Messages are cut from file data on demand as views, without copying,
+        so all sessions share one copy of the file.
 
-    def prepare(self):
-        self.fill_queue(self._binary_data)
+        :param filename: path to the file
+        :param packet_size: max size of data in one message
+        :param use_mmap: file is memory mapped instead of being loaded, pages are read by system when needed
+        :param use_manifest: digests of chunks are computed once for every message size and hash, and saved
+                             next to the file, so sessions (also of next servers) don't hash the file again
+        :param manifest_workers: number of processes computing manifest of big file, 0 if it's computed in place
+        """
+        super().__init__(packet_size, **kwargs)
+        self._filename = filename
+        self._use_mmap = use_mmap
+        self._use_manifest = use_manifest
+        self._manifest_workers = manifest_workers
+        self._manifests = {}
+        self._manifest_builders = {}
+        self._manifests_lock = threading.Lock()
+        self.load()
+        # Manifest for default size of messages is built in background from the start
+        self.get_manifest(packet_size, HashType.SHA3, block=False)
+
+    def load(self):
+        with open(self._filename, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            # Empty file can't be mapped
+            if self._use_mmap and stat.st_size > 0:
+                self._binary_data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._binary_data = file.read()
+        self._version = (stat.st_mtime_ns, stat.st_size)
+        self._view = memoryview(self._binary_data)
+
+    def __getstate__(self):
+        # Copy of the stream maps the file again, so processes share its pages instead of loading it
+        state = super().__getstate__()
+        del state["_binary_data"], state["_view"], state["_manifests"], state["_manifest_builders"]
+        del state["_manifests_lock"]
+        state["_use_mmap"] = True
+        return state
+
+    def __setstate__(self, state):
+        self._manifests = {}
+        self._manifest_builders = {}
+        self._manifests_lock = threading.Lock()
+        super().__setstate__(state)
+        self.load()
+
+    def create_reader(self) -> StreamReader:
+        return FileReader(self)
+
+    def get_manifest(self, chunk_size: int, hash_type: HashType, block: bool = True):
+        """
+        The first call starts building of manifest in background thread, the next ones don't build it again.
+
+        :param block: wait until manifest is built, otherwise None is returned until it's ready
+        """
+        if not self._use_manifest or hash_type.size == 0:
+            return None
+        key = (chunk_size, hash_type)
+        manifest = self._manifests.get(key)
+        if manifest is None:
+            with self._manifests_lock:
+                builder = self._manifest_builders.get(key)
+                if builder is None and key not in self._manifests:
+                    builder = threading.Thread(target=self.build_manifest, args=(chunk_size, hash_type), daemon=True)
+                    self._manifest_builders[key] = builder
+                    builder.start()
+            if block and builder is not None:
+                builder.join()
+            manifest = self._manifests.get(key)
+        return manifest
+
+    def build_manifest(self, chunk_size: int, hash_type: HashType):
+        manifest = Manifest.load(self._filename, self._version, chunk_size, hash_type)
+        if manifest is None:
+            manifest = Manifest.compute(self._filename, self._view, self._version, chunk_size, hash_type,
+                                        self._manifest_workers)
+            manifest.save(self._filename)
+        with self._manifests_lock:
+            self._manifests[(chunk_size, hash_type)] = manifest
+            del self._manifest_builders[(chunk_size, hash_type)]
+
+    def get_size(self) -> int:
+        return len(self._binary_data)
+
+    def get_version(self) -> int:
+        return self._version[0]
+
+    def get_chunk_count(self) -> int:
+        return (len(self._binary_data) + self._message_size - 1) // self._message_size
+
+    def get_chunk(self, idx: int) -> memoryview:
+        return self.get_range(idx * self._message_size, self._message_size)
+
+    def get_range(self, start: int, size: int) -> memoryview:
+        return self._view[start:start + size]
 
     def get_data(self, encoding):
-        return self._binary_data.decode(encoding)
+        return self.get_binary_data().decode(encoding)
 
     def get_binary_data(self):
-        return self._binary_data
+        return self._binary_data[:]
 
 
 class Ping(Stream):
-    def __init__(self, delay: float):
+    def __init__(self, delay: float, **kwargs):
         """
         Simple infinite stream, which sends small message 'PING' every x seconds.
 
         :param delay: delay between pings
         """
-        super().__init__()
+        super().__init__(**kwargs)
         self.delay = delay
-        self.stop = False
+        self.stop = threading.Event()
 
-    def prepare(self):
-        self.stop = False
-        threading.Thread(target=lambda: self.add_message()).start()
+    def create_reader(self) -> StreamReader:
+        return LiveReader(self)
 
-    def get_next_message(self, timeout):
-        return self.messages.get(timeout=timeout)
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["stop"]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.stop = threading.Event()
+
+    def prepare(self):
+        # Previous producer could still be sleeping, it keeps its own stop event
+        self.stop = threading.Event()
+        threading.Thread(target=self.add_message, args=(self.stop,)).start()
 
     def close(self):
-        self.stop = True
+        self.stop.set()
 
-    def add_message(self):
-        while not self.stop:
+    def add_message(self, stop: threading.Event):
+        while not stop.is_set():
             self.fill_queue(b"PING")
             time.sleep(self.delay)
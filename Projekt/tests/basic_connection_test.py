@@ -3,10 +3,14 @@
 # Data:           14.01.2022
 
 import logging
+import shutil
+from threading import Thread
 
-from streams import File
+from streams import File, Ping
 from server import Server
 from client import ClientV4, ClientV6
+from message import Message, MessageType, HashType, ErrorType, RequestMessage
+import CONFIG as CFG
 
 
 class TestBasicConnectionV4:
@@ -59,3 +63,291 @@ class TestTwinConnection:
         assert "1234567890\r\ntest\r\nzażółć gęsią jaźń" == data.decode("utf-8")
 
         server.stop()
+
+
+class TestWindowedConnection:
+    def test_windowed_connection_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        client.buffer.capacity = 8
+        data = client.request(1, ("127.0.0.1", receive_port))
+        assert stream.get_binary_data() == data
+
+        # Server can't send more than client is able to accept
+        assert server.threads[0].WINDOW_SIZE == 8
+
+        server.stop()
+
+    def test_memory_mapped_file_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png", use_mmap=True)
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        data = client.request(1, ("127.0.0.1", receive_port))
+        assert stream.get_binary_data() == data
+
+        server.stop()
+
+
+class TestConcurrentConnections:
+    def test_concurrent_clients_same_stream(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        results = [None] * 4
+
+        def receive(i):
+            client = ClientV4(logging_level=logging.CRITICAL, turn_on_signals=False)
+            results[i] = client.request(1, ("127.0.0.1", receive_port))
+
+        threads = [Thread(target=receive, args=(i,)) for i in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every client gets the whole file
+        assert all(result == stream.get_binary_data() for result in results)
+
+        server.stop()
+
+
+class TestNegotiatedHash:
+    def test_every_hash_type_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        for hash_type in HashType:
+            client = ClientV4(logging_level=logging.CRITICAL, hash_type=hash_type)
+            data = client.request(1, ("127.0.0.1", receive_port))
+            assert stream.get_binary_data() == data
+            assert server.threads[-1].HASH_TYPE == hash_type
+
+        server.stop()
+
+    def test_file_manifest_ipv4(self, tmp_path):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File(shutil.copy("resources/gnome.png", tmp_path), use_manifest=True)
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        # Data is checked by client with digests computed before the session
+        for hash_type in HashType:
+            client = ClientV4(logging_level=logging.CRITICAL, hash_type=hash_type)
+            data = client.request(1, ("127.0.0.1", receive_port))
+            assert stream.get_binary_data() == data
+
+        server.stop()
+
+
+class LimitedPathClient(ClientV4):
+    def __init__(self, limit: int, **kwargs):
+        super().__init__(**kwargs)
+        self.limit = limit
+
+    def send_message(self, message: Message, target: tuple[str, int]):
+        # Probes bigger than limit are lost on the way, they're never confirmed
+        if message.message_type != MessageType.PRB or message.identifier <= self.limit:
+            super().send_message(message, target)
+
+
+class PayloadLimitClient(ClientV4):
+    def __init__(self, max_payload_size: int, **kwargs):
+        super().__init__(**kwargs)
+        self.max_payload_size = max_payload_size
+
+    def send_message(self, message: Message, target: tuple[str, int]):
+        # Request announces limit of data size, which no message can meet
+        if message.message_type == MessageType.REQ:
+            message = RequestMessage(message.identifier, self.receive_port, self.buffer.capacity, self.HASH_TYPE,
+                                     self.max_payload_size)
+        super().send_message(message, target)
+
+
+class TestPathProbing:
+    def test_probed_payload_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        data = client.request(1, ("127.0.0.1", receive_port))
+        assert stream.get_binary_data() == data
+
+        # Local path carries the biggest allowed messages
+        assert server.threads[0].payload_size == Message.MAX_PAYLOAD_SIZE
+
+        server.stop()
+
+    def test_invalid_payload_limit_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        for max_payload_size in (0, -1):
+            client = PayloadLimitClient(max_payload_size, logging_level=logging.CRITICAL)
+            assert client.request(1, ("127.0.0.1", receive_port)) == stream.get_binary_data()
+            assert server.threads[-1].payload_size == Message.MAX_DATA_SIZE
+
+        server.stop()
+
+    def test_lost_probes_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = LimitedPathClient(1000, logging_level=logging.CRITICAL)
+        data = client.request(1, ("127.0.0.1", receive_port))
+        assert stream.get_binary_data() == data
+
+        # Binary search stops close to the real limit
+        assert 1000 - CFG.SERVER_PROBE_PRECISION <= server.threads[0].payload_size <= 1000
+
+        server.stop()
+
+    def test_all_probes_lost_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = LimitedPathClient(0, logging_level=logging.CRITICAL)
+        data = client.request(1, ("127.0.0.1", receive_port))
+        assert stream.get_binary_data() == data
+
+        # Default size is used, when no probe gets through
+        assert server.threads[0].payload_size == Message.MAX_DATA_SIZE
+
+        server.stop()
+
+
+class TestMultiplexedSession:
+    def test_many_files_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        image, text = File("resources/gnome.png"), File("tests/resources/test_file.txt")
+        server.register_stream(1, image)
+        server.register_stream(2, text)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        results = client.request_many([1, 2, 1], ("127.0.0.1", receive_port))
+        assert results == [image.get_binary_data(), text.get_binary_data(), image.get_binary_data()]
+
+        # All streams were sent by one session
+        assert len(server.threads) == 1
+
+        server.stop()
+
+    def test_too_many_channels_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        server.register_stream(1, File("tests/resources/test_file.txt"))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        # Streams exist, but they don't fit in one session
+        client = ClientV4(logging_level=logging.CRITICAL)
+        results = client.request_many([1] * (Message.MAX_CHANNELS + 1), ("127.0.0.1", receive_port))
+        assert not any(results)
+        assert client.error == ErrorType.TOO_MANY_CHANNELS
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        client.request_many([1, 3], ("127.0.0.1", receive_port))
+        assert client.error == ErrorType.STREAM_NOT_FOUND
+
+        server.stop()
+
+    def test_file_with_live_stream_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        image = File("resources/gnome.png")
+        server.register_stream(1, image)
+        server.register_stream(2, Ping(0.01))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        data, pings = bytearray(), 0
+        for idx, chunk in client.iter_request_many([1, 2], ("127.0.0.1", receive_port)):
+            if idx == 0:
+                data += chunk
+            else:
+                assert chunk == b"PING"
+                pings += 1
+            if len(data) == image.get_size() and pings >= 3:
+                break
+
+        # Endless stream didn't hold back the file
+        assert data == image.get_binary_data()
+
+        server.stop()
+
+    def test_too_many_streams_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        server.register_stream(1, File("tests/resources/test_file.txt"))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        results = client.request_many([1] * (Message.MAX_CHANNELS + 1), ("127.0.0.1", receive_port))
+        assert not any(results)
+
+        server.stop()
+
+
+class JunkClient(ClientV4):
+    def receive_message(self) -> Message:
+        # Session gets malformed datagrams along with ACKs
+        message = super().receive_message()
+        if message.message_type == MessageType.MSG and self.ack_port is not None:
+            self.send_socket.sendto(b"abc", (self.target_ip, self.ack_port))
+        return message
+
+
+class TestInvalidMessages:
+    def test_junk_sent_to_session_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = JunkClient(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port)) == stream.get_binary_data()
+
+        server.stop()
@@ -0,0 +1,144 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import logging
+import socket
+from time import monotonic
+
+from pytest import approx
+from session import CongestionController, Session
+from message import Message, ACKMessage
+from common import TokenBucket
+from streams import File
+from server import Server, EventLoopServer
+from client import ClientV4
+
+
+class TestCongestionController:
+    def test_slow_start(self):
+        congestion = CongestionController(4, 2, 100)
+        congestion.confirm(4, 1)
+        assert congestion.get_window() == 8
+        congestion.confirm(8, 2)
+        assert congestion.get_window() == 16
+
+    def test_loss_halves_window(self):
+        congestion = CongestionController(20, 2, 100)
+        congestion.lose(1, 2)
+        assert congestion.get_window() == 10
+        # Messages sent before the decrease belong to the same congestion event
+        congestion.lose(1.5, 3)
+        congestion.confirm(5, 1.5)
+        assert congestion.get_window() == 10
+
+        # Window grows by one message per window in congestion avoidance
+        congestion.confirm(10, 4)
+        assert congestion.window == approx(11)
+
+    def test_timeout(self):
+        congestion = CongestionController(20, 2, 100)
+        congestion.timeout(1)
+        assert congestion.get_window() == 2
+        assert congestion.ssthresh == 10
+        assert congestion.stats()["timeouts"] == 1
+
+        for _ in range(20):
+            congestion.confirm(100, 2)
+        assert congestion.get_window() == 100
+
+
+class TestLossDetection:
+    def test_reordering_isnt_loss(self):
+        receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receive_socket.bind(("127.0.0.1", 0))
+        send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        session = Session([File("resources/gnome.png").open()], receive_socket.getsockname(),
+                          logging.getLogger(__name__), send_socket, 0, window_size=32)
+
+        def acknowledge(identifier, received=()):
+            message = Message.unpack(ACKMessage(identifier, received, hash_type=session.HASH_TYPE).pack())
+            session.handle_message(message)
+
+        try:
+            session.open()
+            acknowledge(0)
+            session.fill_window(block=False)
+            assert session.in_flight() == session.congestion.get_window()
+            window = session.congestion.window
+
+            # Two messages overtook the second one, it could still be on the way
+            acknowledge(1, [3, 4])
+            assert session.retransmissions == 0
+            assert session.congestion.stats()["losses"] == 0
+            # The third one means it was lost, one loss for the whole event
+            acknowledge(1, [3, 4, 5, 6])
+            assert session.retransmissions == 1
+            assert session.congestion.stats()["losses"] == 1
+            assert session.congestion.window < window
+            # Retransmitted message isn't lost again by the next ACKs
+            acknowledge(1, [3, 4, 5, 6, 7])
+            assert session.retransmissions == 1
+        finally:
+            session.channels[0].stream.close()
+            receive_socket.close()
+            send_socket.close()
+
+
+class TestPacing:
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000, 100)
+        now = bucket.updated
+        assert bucket.delay(now) == 0
+        # Message bigger than tokens is sent, the next one waits until debt is paid
+        bucket.consume(400)
+        assert bucket.delay(now) == approx(0.301)
+        assert bucket.delay(now + 0.4) == 0
+
+    def test_stream_rate_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png", rate=500_000)
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        start = monotonic()
+        assert client.request(1, ("127.0.0.1", receive_port)) == stream.get_binary_data()
+        assert monotonic() - start >= stream.get_size() / 500_000 - 0.05
+
+        server.stop()
+
+    def test_high_stream_rate_ipv4(self, tmp_path):
+        # Pacing deadline is often already over, when session starts waiting for ACK
+        filename = tmp_path / "data.bin"
+        filename.write_bytes(bytes(range(256)) * 12_000)
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File(filename, rate=50_000_000)
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port)) == stream.get_binary_data()
+
+        server.stop()
+
+    def test_server_rate_ipv4(self):
+        server = EventLoopServer(logging_level=logging.CRITICAL, rate_limit=1_000_000)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        # Clients share the limit of the server
+        start = monotonic()
+        for _ in range(2):
+            client = ClientV4(logging_level=logging.CRITICAL)
+            assert client.request(1, ("127.0.0.1", receive_port)) == stream.get_binary_data()
+        assert monotonic() - start >= 2 * stream.get_size() / 1_000_000 - 0.05
+
+        server.stop()
@@ -0,0 +1,98 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import logging
+import socket
+from threading import Thread
+
+from common import TimerWheel
+from streams import File, Ping
+from server import EventLoopServer
+from client import ClientV4, ClientV6
+from message import RequestMessage
+
+
+class TestTimerWheel:
+    def test_timers_expire_in_order(self):
+        timers = TimerWheel(0.01, size=8)
+        start = timers.current_time
+        timers.schedule(start + 0.03, "second")
+        timers.schedule(start + 0.01, "first")
+        timers.schedule(start + 0.5, "late")
+
+        assert timers.advance(start + 0.005) == []
+        assert timers.advance(start + 0.015) == ["first"]
+        assert timers.advance(start + 0.1) == ["second"]
+        # Timer later than one turn of the wheel waits for its round
+        assert timers.advance(start + 0.49) == []
+        assert timers.advance(start + 0.51) == ["late"]
+
+
+class TestEventLoopServer:
+    def test_basic_connection(self):
+        server = EventLoopServer(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port_v4, *_ = server.ipv4_receive_address
+        _, receive_port_v6, *_ = server.ipv6_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port_v4)) == stream.get_binary_data()
+
+        client = ClientV6(logging_level=logging.CRITICAL)
+        assert client.request(1, ("::1", receive_port_v6)) == stream.get_binary_data()
+
+        server.stop()
+        assert not server.sessions
+
+    def test_invalid_messages_dropped(self):
+        server = EventLoopServer(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        # Too short datagram, unknown message type and unknown hash don't stop the loop
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as junk_socket:
+            for junk in (b"abc", bytes([255]) + bytes(20), bytes([1, 0, 0, 0, 0, 0, 0, 15]) + bytes(12)):
+                junk_socket.sendto(junk, ("127.0.0.1", receive_port))
+            # Requests of existing and unknown stream with port, where nothing can be sent
+            for stream_id, port in ((1, 70000), (1, -1), (1, 0), (2, 70000)):
+                junk_socket.sendto(RequestMessage(stream_id, port).pack(), ("127.0.0.1", receive_port))
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port)) == stream.get_binary_data()
+
+        server.stop()
+
+    def test_many_connections(self):
+        server = EventLoopServer(logging_level=logging.CRITICAL)
+        server.register_stream(1, File("tests/resources/test_file.txt"))
+        server.register_stream(2, Ping(0.01))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        results = [None] * 16
+
+        def receive(i):
+            client = ClientV4(logging_level=logging.CRITICAL, turn_on_signals=False)
+            if i % 2:
+                results[i] = client.request(1, ("127.0.0.1", receive_port))
+            else:
+                results[i] = client.request(2, ("127.0.0.1", receive_port), max_messages=5)
+
+        threads = [Thread(target=receive, args=(i,)) for i in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert all(result.decode("utf-8") == "1234567890\r\ntest\r\nzażółć gęsią jaźń" for result in results[1::2])
+        assert all(result.decode("utf-8") == "PING" * 5 for result in results[::2])
+
+        server.stop()
@@ -25,5 +25,5 @@ class TestLaggedConnection:
         assert "1234567890\r\ntest\r\nzażółć gęsią jaźń" == data.decode("utf-8")
 
         # Timeout was adjusted for client lag
-        assert server.threads[0].SERVER_ACK_TIMEOUT == 4.096
+        assert server.threads[0].rtt.timeout >= 1
         server.stop()
@@ -2,7 +2,8 @@
 # Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
 # Data:           14.01.2022
 
-from message import DataMessage, Message, ACKMessage, MessageType
+import pytest
+from message import DataMessage, Message, ACKMessage, RequestMessage, InfoMessage, QuitMessage, MessageType, HashType
 
 
 class TestMessage:
@@ -27,3 +28,89 @@ class TestMessage:
         recv_ack_message = Message.unpack(ack_message)
         assert recv_ack_message.message_type == MessageType.ACK
         assert recv_ack_message.identifier == 1
+
+    def test_request_window(self):
+        message = RequestMessage(1, 8080, 16).pack()
+
+        recv_message = Message.unpack(message)
+        assert recv_message.message_type == MessageType.REQ
+        assert recv_message.data_to_int(0) == 8080
+        assert recv_message.data_to_int(1) == 16
+
+    def test_request_options(self):
+        message = Message.unpack(RequestMessage(1, 8080, 16, HashType.CRC32, fec_group=255).pack())
+        options = message.data_to_int(2)
+        assert options & 0xFF == HashType.CRC32.value
+        assert options >> 8 & 0xFF == 255
+        # Size of parity group doesn't leak into flags
+        assert options >> 16 & RequestMessage.HAS_RANGE == 0
+
+        with pytest.raises(ValueError):
+            RequestMessage(1, 8080, fec_group=256)
+        with pytest.raises(ValueError):
+            RequestMessage(1, 8080, fec_group=-1)
+
+    def test_selective_ack(self):
+        message = ACKMessage(3, [5, 7, 20]).pack()
+
+        recv_message = Message.unpack(message)
+        assert recv_message.message_type == MessageType.ACK
+        assert recv_message.identifier == 3
+        assert recv_message.check_hash()
+        assert recv_message.data_to_bitmap(recv_message.identifier + 1) == [5, 7, 20]
+
+    def test_info_stream_size(self):
+        message = InfoMessage(0, 8080, 2 ** 40).pack()
+
+        recv_message = Message.unpack(message)
+        assert recv_message.message_type == MessageType.INF
+        assert recv_message.data_to_int(0) == 8080
+        assert recv_message.data_to_long(1) == 2 ** 40
+        assert recv_message.data_to_long(3) == 2 ** 40
+
+        # Requested range of the stream is smaller than the whole stream
+        recv_message = Message.unpack(InfoMessage(0, 8080, 100, 2 ** 40, 12345).pack())
+        assert recv_message.data_to_long(1) == 100
+        assert recv_message.data_to_long(3) == 2 ** 40
+        assert recv_message.data_to_long(5) == 12345
+
+    def test_pack_into_buffer(self):
+        buffer = memoryview(bytearray(Message.MAX_MESSAGE_SIZE))
+        message = DataMessage(2, b"TEST")
+
+        size = message.pack_into(buffer)
+        assert buffer[:size] == message.pack()
+
+        recv_message = Message.unpack(buffer[:size])
+        assert recv_message.identifier == 2
+        assert recv_message.data == b"TEST"
+        assert recv_message.check_hash()
+
+    def test_frozen_message(self):
+        message = QuitMessage(1).freeze()
+        packed = message.pack()
+        assert message.pack() is packed
+
+        buffer = memoryview(bytearray(Message.MAX_MESSAGE_SIZE))
+        assert buffer[:message.pack_into(buffer)] == packed
+        assert Message.unpack(packed).message_type == MessageType.FIN
+
+    def test_corrupted_data(self):
+        packed = bytearray(DataMessage(1, b"TEST").pack())
+        packed[-1] ^= 1
+        assert not Message.unpack(bytes(packed)).check_hash()
+
+    def test_hash_types(self):
+        for hash_type in HashType:
+            message = DataMessage(1, b"TEST", hash_type).pack()
+            # Header is only as long as the hash
+            assert len(message) == 16 + hash_type.size + 4
+
+            recv_message = Message.unpack(message)
+            assert recv_message.hash_type == hash_type
+            assert recv_message.data == b"TEST"
+            assert recv_message.check_hash()
+
+        corrupted = bytearray(DataMessage(1, b"TEST", HashType.CRC32).pack())
+        corrupted[-1] ^= 1
+        assert not Message.unpack(bytes(corrupted)).check_hash()
@@ -0,0 +1,51 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import logging
+from threading import Thread
+
+from streams import File
+from server import MultiProcessServer
+from client import ClientV4, ClientV6
+
+
+class TestMultiProcessServer:
+    def test_workers(self):
+        server = MultiProcessServer(workers=2, logging_level=logging.CRITICAL)
+        server.register_stream(1, File("resources/gnome.png"))
+        _, receive_port_v4, *_ = server.ipv4_receive_address
+        _, receive_port_v6, *_ = server.ipv6_receive_address
+
+        server.start()
+        # Streams can be registered also when workers are running
+        stream = File("tests/resources/test_file.txt")
+        server.register_stream(2, stream)
+
+        results = [None] * 8
+
+        def receive(i):
+            if i % 2:
+                client = ClientV4(logging_level=logging.CRITICAL, turn_on_signals=False)
+                results[i] = client.request(1 + i % 4 // 2, ("127.0.0.1", receive_port_v4))
+            else:
+                client = ClientV6(logging_level=logging.CRITICAL, turn_on_signals=False)
+                results[i] = client.request(1 + i % 4 // 2, ("::1", receive_port_v6))
+
+        threads = [Thread(target=receive, args=(i,)) for i in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with open("resources/gnome.png", "rb") as file:
+            expected_data = file.read()
+        for i, result in enumerate(results):
+            assert result == (expected_data if i % 4 < 2 else stream.get_binary_data())
+
+        stats = server.get_stats()
+        assert len(stats["workers"]) == 2
+        assert stats["closed_sessions"] == 8
+        assert stats["active_sessions"] == 0
+
+        server.stop()
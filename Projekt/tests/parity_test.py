@@ -0,0 +1,89 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import logging
+
+from streams import File
+from server import Server, EventLoopServer
+from session import ParityEncoder
+from client import ClientV4, ParityDecoder, ReorderBuffer
+from message import Message, DataMessage, MessageType
+
+
+class FECLossyClient(ClientV4):
+    def receive_message(self) -> Message:
+        # Every copy of the third message is lost
+        message = super().receive_message()
+        while message.message_type == MessageType.MSG and message.identifier == 3:
+            message = super().receive_message()
+        return message
+
+
+class TestParity:
+    def test_rebuild_message(self):
+        messages = [DataMessage(idx, data) for idx, data in enumerate((b"first", b"second one", b"", b"x"), start=1)]
+        encoder = ParityEncoder(4)
+        assert not any(encoder.add(message) for message in messages[:3])
+        assert encoder.add(messages[3])
+        parity = encoder.flush(messages[0].hash_type)
+        assert parity.identifier == 1
+
+        # Any message of the group can be rebuilt from the other ones
+        for lost in range(4):
+            buffer, decoder = ReorderBuffer(8), ParityDecoder(4)
+            for idx, message in enumerate(messages):
+                if idx != lost:
+                    buffer.add(message)
+                    decoder.add_data(message, buffer)
+            recovered = decoder.add_parity(Message.unpack(parity.pack()), buffer)
+            assert [(message.identifier, message.data) for message in recovered] == \
+                   [(messages[lost].identifier, messages[lost].data)]
+
+    def test_parity_too_late(self):
+        messages = [DataMessage(idx, bytes([idx]) * 10) for idx in range(1, 4)]
+        encoder = ParityEncoder(3)
+        for message in messages:
+            encoder.add(message)
+        parity = encoder.flush(messages[0].hash_type)
+
+        # Two lost messages can't be rebuilt, until one of them is sent again
+        buffer, decoder = ReorderBuffer(8), ParityDecoder(3)
+        buffer.add(messages[0])
+        assert decoder.add_data(messages[0], buffer) == []
+        assert decoder.add_parity(parity, buffer) == []
+        buffer.add(messages[2])
+        recovered = decoder.add_data(messages[2], buffer)
+        assert [message.data for message in recovered] == [messages[1].data]
+        assert decoder.recovered == 1
+
+    def test_lost_message_rebuilt_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = FECLossyClient(logging_level=logging.CRITICAL, fec_group=4)
+        data = client.request(1, ("127.0.0.1", receive_port))
+        assert stream.get_binary_data() == data
+        assert client.recovered_messages == 1
+        assert server.threads[0].parity_messages > 0
+
+        server.stop()
+
+    def test_without_parity_ipv4(self):
+        server = EventLoopServer(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port)) == stream.get_binary_data()
+        assert client.recovered_messages == 0
+        assert server.get_stats()["parity_messages"] == 0
+
+        server.stop()
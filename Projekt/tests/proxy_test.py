@@ -0,0 +1,58 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import logging
+
+from streams import File
+from server import Server
+from client import ClientV4, ClientV6
+from proxy import LossyProxy, NetworkConditions, Link
+
+
+class TestLossyProxy:
+    def test_ideal_network_ipv4(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        server.start()
+
+        proxy = LossyProxy(("127.0.0.1", server.ipv4_receive_address[1]), logging_level=logging.CRITICAL)
+        proxy.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        data = client.request(1, proxy.receive_address[:2])
+        assert stream.get_binary_data() == data
+        assert proxy.get_stats()["downlink"]["lost"] == 0
+
+        proxy.stop()
+        server.stop()
+
+    def test_impaired_network_ipv6(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        server.start()
+
+        conditions = NetworkConditions(loss=0.05, duplication=0.05, reordering=0.1, delay=0.001, jitter=0.002,
+                                       bandwidth=10_000_000, seed=7)
+        proxy = LossyProxy(("::1", server.ipv6_receive_address[1]), conditions, logging_level=logging.CRITICAL)
+        proxy.start()
+
+        client = ClientV6(logging_level=logging.CRITICAL)
+        data = client.request(1, proxy.receive_address[:2])
+        assert stream.get_binary_data() == data
+
+        # Lost messages were sent again
+        stats = proxy.get_stats()
+        assert stats["downlink"]["lost"] > 0
+        assert server.threads[0].retransmissions > 0
+
+        proxy.stop()
+        server.stop()
+
+    def test_seeded_decisions(self):
+        conditions = NetworkConditions(loss=0.3, duplication=0.2, reordering=0.2, jitter=0.01, seed=3)
+        first, second = Link(conditions, conditions.seed), Link(conditions, conditions.seed)
+        assert [first.schedule(400, i) for i in range(100)] == [second.schedule(400, i) for i in range(100)]
+        assert first.stats == second.stats
@@ -0,0 +1,46 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+from client import ReorderBuffer
+from message import DataMessage
+
+
+class TestReorderBuffer:
+    def test_in_order(self):
+        buffer = ReorderBuffer(4)
+        assert buffer.add(DataMessage(1, b"A"))
+        assert buffer.pop().data == b"A"
+        assert buffer.pop() is None
+        assert buffer.stats()["buffered"] == 0
+
+    def test_gap_filled(self):
+        buffer = ReorderBuffer(4)
+        assert buffer.add(DataMessage(3, b"C"))
+        assert buffer.add(DataMessage(2, b"B"))
+        assert buffer.pop() is None
+        assert buffer.received() == [3, 2]
+
+        assert buffer.add(DataMessage(1, b"A"))
+        assert [buffer.pop().data for _ in range(3)] == [b"A", b"B", b"C"]
+        assert buffer.stats() == {"held": 0, "buffered": 2, "discarded": 0, "duplicates": 0,
+                                  "skipped": 0}
+
+    def test_bounded(self):
+        buffer = ReorderBuffer(4)
+        assert not buffer.add(DataMessage(5, b"E"))
+        assert buffer.add(DataMessage(4, b"D"))
+        assert not buffer.add(DataMessage(4, b"D"))
+        assert not buffer.is_received(5)
+        assert buffer.stats() == {"held": 1, "buffered": 1, "discarded": 1, "duplicates": 1, "skipped": 0}
+
+    def test_skip(self):
+        buffer = ReorderBuffer(4)
+        assert buffer.add(DataMessage(2, b"B"))
+        buffer.skip(4)
+        # Received message is released, missing ones are skipped
+        assert buffer.pop().data == b"B"
+        assert buffer.pop() is None
+        assert buffer.next_identifier == 4
+        assert buffer.stats()["skipped"] == 2
+        assert buffer.is_received(3)
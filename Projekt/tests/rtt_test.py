@@ -0,0 +1,34 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+from pytest import approx
+from session import RTTEstimator
+
+
+class TestRTTEstimator:
+    def test_first_measurement(self):
+        rtt = RTTEstimator(1, 0.001, 10)
+        rtt.update(0.1)
+        assert rtt.srtt == approx(0.1)
+        assert rtt.rttvar == approx(0.05)
+        assert rtt.timeout == approx(0.3)
+
+    def test_timeout_shrinks(self):
+        rtt = RTTEstimator(0.001, 0.001, 10)
+        for _ in range(12):
+            rtt.backoff()
+        assert rtt.timeout == approx(4.096)
+
+        for _ in range(10):
+            rtt.update(0.01)
+        assert rtt.timeout < 0.1
+        assert rtt.stats()["samples"] == 10
+
+    def test_timeout_limits(self):
+        rtt = RTTEstimator(1, 0.5, 2)
+        rtt.update(0.001)
+        assert rtt.timeout == 0.5
+        for _ in range(5):
+            rtt.backoff()
+        assert rtt.timeout == 2
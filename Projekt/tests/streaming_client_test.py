@@ -0,0 +1,293 @@
+# Nazwa projektu: System niezawodnego strumieniowania danych po UDP
+# Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
+# Data:           14.01.2022
+
+import asyncio
+import logging
+import os
+import shutil
+import socket
+from threading import Timer
+from time import monotonic
+
+import pytest
+from streams import File, Ping
+from server import Server
+from client import ClientV4
+from message import Message, MessageType
+
+
+class LossyClient(ClientV4):
+    def receive_message(self) -> Message:
+        # Every copy of the third message is lost
+        message = super().receive_message()
+        while message.message_type == MessageType.MSG and message.identifier == 3:
+            message = super().receive_message()
+        return message
+
+
+class StripeLossClient(ClientV4):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.SERVER_NOT_RESPONDING_TIMEOUT = 0.5
+        self.start = 0
+
+    def send_request(self, stream, target, streams=(), start=0, length=-1):
+        self.start = start
+        super().send_request(stream, target, streams, start, length)
+
+    def receive_message(self) -> Message:
+        # Every data message of ranges after the first one is lost
+        message = super().receive_message()
+        while self.start > 0 and message.message_type == MessageType.MSG:
+            message = super().receive_message()
+        return message
+
+
+class TestStreamingClient:
+    def test_iter_request(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        chunks = list(client.iter_request(1, ("127.0.0.1", receive_port)))
+        assert all(len(chunk) <= Message.MAX_PAYLOAD_SIZE for chunk in chunks)
+        assert b"".join(chunks) == stream.get_binary_data()
+
+        # Data isn't accumulated by the client
+        assert len(client.result) == 0
+
+        server.stop()
+
+    def test_iter_request_stopped_early(self):
+        server = Server(logging_level=logging.CRITICAL)
+        server.register_stream(1, Ping(0.01))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        for i, chunk in enumerate(client.iter_request(1, ("127.0.0.1", receive_port))):
+            assert chunk == b"PING"
+            if i == 2:
+                break
+        assert not client.is_running
+
+        server.stop()
+
+    def test_aiter_request(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("tests/resources/test_file.txt")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        async def receive():
+            client = ClientV4(logging_level=logging.CRITICAL)
+            return [chunk async for chunk in client.aiter_request(1, ("127.0.0.1", receive_port))]
+
+        assert b"".join(asyncio.run(receive())) == stream.get_binary_data()
+
+        server.stop()
+
+    def test_download(self, tmp_path):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        filename = tmp_path / "gnome.png"
+        written = client.download(1, ("127.0.0.1", receive_port), filename)
+        assert written == stream.get_size()
+        assert filename.read_bytes() == stream.get_binary_data()
+
+        server.stop()
+
+    def test_resume_download(self, tmp_path):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        # The first download is interrupted, its progress stays in journal
+        filename = tmp_path / "gnome.png"
+        journal = tmp_path / "gnome.png.part"
+        first = ClientV4(logging_level=logging.CRITICAL).download(1, ("127.0.0.1", receive_port), filename, 10)
+        assert 0 < first < stream.get_size()
+        assert journal.exists()
+
+        second = ClientV4(logging_level=logging.CRITICAL).download(1, ("127.0.0.1", receive_port), filename)
+        assert first + second == stream.get_size()
+        assert filename.read_bytes() == stream.get_binary_data()
+        assert not journal.exists()
+
+        server.stop()
+
+    def test_download_striped(self, tmp_path, monkeypatch):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        server.register_stream(2, Ping(0.001))
+        empty = tmp_path / "empty.txt"
+        empty.touch()
+        server.register_stream(3, File(empty))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request_size(1, ("127.0.0.1", receive_port)) == stream.get_size()
+
+        for stripes in (1, 3, 64):
+            filename = tmp_path / f"gnome-{stripes}.png"
+            client = ClientV4(logging_level=logging.CRITICAL)
+            written = client.download_striped(1, ("127.0.0.1", receive_port), filename, stripes)
+            assert written == stream.get_size()
+            assert 0 < len(client.stripe_clients) <= stripes
+            assert all(stripe.receive_socket.fileno() == -1 for stripe in client.stripe_clients)
+            assert filename.read_bytes() == stream.get_binary_data()
+
+        # Short writes are continued, no part of the message is lost
+        pwrite = os.pwrite
+        monkeypatch.setattr(os, "pwrite", lambda fd, data, offset: pwrite(fd, data[:100], offset))
+        filename = tmp_path / "gnome-short.png"
+        assert ClientV4(logging_level=logging.CRITICAL).download_striped(1, ("127.0.0.1", receive_port),
+                                                                         filename, 3) == stream.get_size()
+        assert filename.read_bytes() == stream.get_binary_data()
+        monkeypatch.undo()
+
+        # File with missing range isn't left behind
+        filename = tmp_path / "gnome-lost.png"
+        with pytest.raises(ConnectionError):
+            StripeLossClient(logging_level=logging.CRITICAL).download_striped(1, ("127.0.0.1", receive_port),
+                                                                              filename, 3)
+        assert not filename.exists()
+
+        # Live stream can't be split, it has no size
+        assert ClientV4(logging_level=logging.CRITICAL).request_size(2, ("127.0.0.1", receive_port)) == -1
+
+        # Empty file has nothing to split, older content of the output file is dropped
+        filename = tmp_path / "empty-copy.txt"
+        filename.write_bytes(b"old content")
+        assert ClientV4(logging_level=logging.CRITICAL).download_striped(3, ("127.0.0.1", receive_port),
+                                                                         filename, 3) == 0
+        assert filename.read_bytes() == b""
+
+        server.stop()
+
+    def test_resume_changed_file(self, tmp_path, monkeypatch):
+        source = shutil.copy("resources/gnome.png", tmp_path / "source.png")
+        server = Server(logging_level=logging.CRITICAL)
+        server.register_stream(1, File(source))
+        _, receive_port, *_ = server.ipv4_receive_address
+        server.start()
+
+        filename = tmp_path / "gnome.png"
+        first = ClientV4(logging_level=logging.CRITICAL).download(1, ("127.0.0.1", receive_port), filename, 10)
+        assert 0 < first
+        server.stop()
+
+        # File on the server is replaced before the download is resumed
+        with open(source, "r+b") as file:
+            data = file.read()[::-1] + b"new data"
+            file.seek(0)
+            file.write(data)
+        stat = os.stat(source)
+        os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        server = Server(logging_level=logging.CRITICAL)
+        server.register_stream(1, File(source))
+        _, receive_port, *_ = server.ipv4_receive_address
+        server.start()
+
+        # Saved part of the old version is dropped, the new version is downloaded from the beginning
+        clients = []
+        create_client = ClientV4.create_client
+        monkeypatch.setattr(ClientV4, "create_client", lambda self: clients.append(create_client(self)) or clients[-1])
+        client = ClientV4(logging_level=logging.CRITICAL)
+        written = client.download(1, ("127.0.0.1", receive_port), filename)
+        assert written == len(data)
+        assert filename.read_bytes() == data
+        assert not (tmp_path / "gnome.png.part").exists()
+        # Client of the new download is closed, all clients write to the same log handler
+        assert len(clients) == 1 and clients[0].receive_socket.fileno() == -1
+        assert len(client.logger.handlers) == 1
+
+        server.stop()
+
+    def test_ranged_request(self):
+        server = Server(logging_level=logging.CRITICAL)
+        stream = File("resources/gnome.png")
+        server.register_stream(1, stream)
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        data = stream.get_binary_data()
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port), start=1000, length=5000) == data[1000:6000]
+        assert client.stream_size == 5000
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port), start=len(data) - 10) == data[-10:]
+        # Range after the end of file can't be sent
+        client = ClientV4(logging_level=logging.CRITICAL)
+        assert client.request(1, ("127.0.0.1", receive_port), start=len(data) + 1) == b""
+
+        server.stop()
+
+    def test_stale_messages_skipped(self):
+        server = Server(logging_level=logging.CRITICAL)
+        server.register_stream(1, Ping(0.01, max_age=0.1))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = LossyClient(logging_level=logging.CRITICAL)
+        for i, chunk in enumerate(client.iter_request(1, ("127.0.0.1", receive_port))):
+            assert chunk == b"PING"
+            if i == 5:
+                break
+
+        # Client didn't wait for the lost message forever
+        assert client.buffer.stats()["skipped"] == 1
+        assert server.threads[0].skipped_messages == 1
+
+        server.stop()
+
+    def test_server_not_responding(self):
+        silent_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent_socket.bind(("127.0.0.1", 0))
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        client.SERVER_NOT_RESPONDING_TIMEOUT = 0.2
+        start = monotonic()
+        assert client.request(1, silent_socket.getsockname()) == b""
+        # Timeout is measured with clock, not counted from socket timeouts
+        assert 0.2 <= monotonic() - start < 1
+
+        silent_socket.close()
+
+    def test_stop_wakes_client(self):
+        server = Server(logging_level=logging.CRITICAL)
+        server.register_stream(1, Ping(10))
+        _, receive_port, *_ = server.ipv4_receive_address
+
+        server.start()
+
+        client = ClientV4(logging_level=logging.CRITICAL)
+        Timer(0.1, client.stop).start()
+        start = monotonic()
+        client.request(1, ("127.0.0.1", receive_port))
+        # Client waiting for the next ping was stopped at once
+        assert monotonic() - start < 1
+
+        server.stop()
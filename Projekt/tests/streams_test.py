@@ -2,7 +2,15 @@
 # Autorzy:        Michał Matak, Paweł Müller, Jakub Robaczewski, Grzegorz Rusinek
 # Data:           14.01.2022
 
-from streams import File
+import mmap
+import os
+import pickle
+import shutil
+from threading import Thread, Event
+
+from streams import File, Ping, Stream, OverflowPolicy, Manifest
+from message import HashType
+import CONFIG as CFG
 
 
 class TestDataProvider:
@@ -10,3 +18,159 @@ class TestDataProvider:
         data_prov = File("tests/resources/test_file.txt")
         expected_string = "1234567890\r\ntest\r\nzażółć gęsią jaźń"
         assert data_prov.get_data("utf-8") == expected_string
+
+    def test_file_chunks(self):
+        data_prov = File("tests/resources/test_file.txt", packet_size=16)
+        expected_data = data_prov.get_binary_data()
+        assert data_prov.get_chunk_count() == 3
+        assert bytes(data_prov.get_chunk(2)) == expected_data[32:]
+
+        reader = data_prov.open()
+        chunks = []
+        while (chunk := reader.get_next_message(0)) is not None:
+            chunks.append(bytes(chunk))
+        assert b"".join(chunks) == expected_data
+
+    def test_memory_mapped_file(self):
+        data_prov = File("resources/gnome.png", use_mmap=True)
+        with open("resources/gnome.png", "rb") as file:
+            expected_data = file.read()
+        assert data_prov.get_size() == len(expected_data)
+        assert isinstance(data_prov.get_chunk(0), memoryview)
+        assert bytes(data_prov.get_chunk(1)) == expected_data[400:800]
+        assert data_prov.get_binary_data() == expected_data
+
+    def test_readers_independent(self):
+        data_prov = File("tests/resources/test_file.txt", packet_size=16)
+        first_reader = data_prov.open()
+        second_reader = data_prov.open()
+        assert bytes(first_reader.get_next_message(0)) == b"1234567890\r\ntest"
+        assert bytes(first_reader.get_next_message(0)) != b"1234567890\r\ntest"
+        assert bytes(second_reader.get_next_message(0)) == b"1234567890\r\ntest"
+
+    def test_live_stream_broadcast(self):
+        ping = Ping(0.01)
+        first_reader = ping.open()
+        second_reader = ping.open()
+        assert first_reader.get_next_message(1) == b"PING"
+        assert second_reader.get_next_message(1) == b"PING"
+
+        first_reader.close()
+        assert not ping.stop.is_set()
+        second_reader.close()
+        assert ping.stop.is_set()
+
+    def test_stream_copy(self):
+        data_prov = File("resources/gnome.png")
+        data_prov.open()
+        copied_prov = pickle.loads(pickle.dumps(data_prov))
+        assert copied_prov.get_binary_data() == data_prov.get_binary_data()
+        assert isinstance(copied_prov._binary_data, mmap.mmap)
+        assert not copied_prov.get_readers()
+
+        ping = pickle.loads(pickle.dumps(Ping(0.5)))
+        assert ping.delay == 0.5
+
+    def test_queue_overflow(self):
+        stream = Stream(packet_size=1, queue_size=2, overflow_policy=OverflowPolicy.DROP_OLDEST)
+        reader = stream.open()
+        stream.fill_queue(b"abc")
+        assert reader.get_next_message(0) == b"b"
+        assert reader.get_next_message(0) == b"c"
+        assert stream.get_dropped() == 1
+
+        stream = Stream(packet_size=1, queue_size=2, overflow_policy=OverflowPolicy.DROP_NEWEST)
+        reader = stream.open()
+        stream.fill_queue(b"abc")
+        assert reader.get_next_message(0) == b"a"
+        assert reader.get_next_message(0) == b"b"
+        reader.close()
+        # Drops of closed readers are still counted
+        assert stream.get_dropped() == 1
+
+    def test_queue_blocks_producer(self):
+        stream = Stream(packet_size=1, queue_size=1, overflow_policy=OverflowPolicy.BLOCK)
+        reader = stream.open()
+        producer = Thread(target=stream.fill_queue, args=(b"ab",))
+        producer.start()
+        producer.join(0.1)
+        # Producer waits until reader makes space
+        assert producer.is_alive()
+        assert reader.get_next_message(0) == b"a"
+        producer.join(1)
+        assert not producer.is_alive()
+        assert reader.get_next_message(0) == b"b"
+        assert stream.get_dropped() == 0
+
+        # Closed reader doesn't block producer
+        stream.fill_queue(b"c")
+        producer = Thread(target=stream.fill_queue, args=(b"d",))
+        producer.start()
+        reader.close()
+        producer.join(1)
+        assert not producer.is_alive()
+
+
+class TestManifest:
+    def test_manifest_digests(self, tmp_path):
+        filename = shutil.copy("resources/gnome.png", tmp_path)
+        data_prov = File(filename, use_manifest=True)
+        manifest = data_prov.get_manifest(400, HashType.SHA3)
+        assert len(manifest) == data_prov.get_chunk_count()
+        assert all(manifest.get_digest(idx) == HashType.SHA3.digest(data_prov.get_chunk(idx))
+                   for idx in range(len(manifest)))
+
+        reader = data_prov.open()
+        chunk = reader.get_next_message(0)
+        chunk = reader.get_next_message(0)
+        assert reader.get_digest(HashType.SHA3) == HashType.SHA3.digest(chunk)
+
+        # Messages without hash don't need manifest
+        assert data_prov.get_manifest(400, HashType.NONE) is None
+        assert File(filename).get_manifest(400, HashType.SHA3) is None
+
+    def test_manifest_built_in_background(self, tmp_path, monkeypatch):
+        filename = shutil.copy("resources/gnome.png", tmp_path)
+        data_prov = File(filename, use_manifest=True)
+        reader = data_prov.open()
+        reader.set_packet_size(1000)
+        reader.get_next_message(0)
+
+        # Hashing of big file takes long, here it waits until the test lets it go
+        hashed = Event()
+        compute = Manifest.compute
+        monkeypatch.setattr(Manifest, "compute", lambda *args: hashed.wait() and compute(*args))
+        # The first session doesn't wait for hashing of the whole file
+        assert data_prov.get_manifest(1000, HashType.BLAKE2B, block=False) is None
+        assert reader.get_digest(HashType.BLAKE2B) is None
+        hashed.set()
+
+        manifest = data_prov.get_manifest(1000, HashType.BLAKE2B)
+        assert data_prov.get_manifest(1000, HashType.BLAKE2B, block=False) is manifest
+        assert reader.get_digest(HashType.BLAKE2B) == manifest.get_digest(0)
+
+    def test_manifest_saved(self, tmp_path):
+        filename = shutil.copy("resources/gnome.png", tmp_path)
+        manifest = File(filename, use_manifest=True).get_manifest(1000, HashType.CRC32)
+        assert os.path.exists(Manifest.get_path(filename, 1000, HashType.CRC32))
+
+        # Next server reads digests instead of computing them
+        loaded = File(filename, use_manifest=True).get_manifest(1000, HashType.CRC32)
+        assert loaded is not manifest
+        assert loaded.digests == manifest.digests
+
+        # Changed file makes saved manifest stale
+        with open(filename, "ab") as file:
+            file.write(b"new data")
+        data_prov = File(filename)
+        assert Manifest.load(filename, data_prov._version, 1000, HashType.CRC32) is None
+
+    def test_manifest_computed_in_parallel(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(CFG, "MANIFEST_PARALLEL_SIZE", 0)
+        filename = shutil.copy("resources/gnome.png", tmp_path)
+        data_prov = File(filename)
+        manifest = Manifest.compute(filename, data_prov.get_binary_data(), data_prov._version, 400, HashType.BLAKE2B,
+                                    workers=3)
+        assert len(manifest) == data_prov.get_chunk_count()
+        assert all(manifest.get_digest(idx) == HashType.BLAKE2B.digest(data_prov.get_chunk(idx))
+                   for idx in range(len(manifest)))